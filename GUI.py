@@ -15,43 +15,25 @@ User Interface for EEL 4872 Final Project
 
 # general imports
 from typing import List, Dict, Any, Optional
-from random import sample, shuffle
-from numpy import log
-from collections import Counter
+from random import sample
 import time
 
 # gui module import
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 
-# logging user interactions import
+# logging user interactions import, written off the UI thread (see background.setup_logging)
 import logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-# dictionary abbreviations of a question
-ID="id"
-QN="question"
-AN="answer"
-AC="answer choices"
-DF="difficulty"
-
-# indexes for variables in lists
-INCORRECT=ID_=0
-CORRECT=10
-AN_=1
-RS=2
-
-# cognitive ability levels & their mapping
-COGNITIVE_ABILITIES_STRING=["low", "medium", "high"]
-LOW, MEDIUM, HIGH = 0, 1, 2
-DIFF_MAP={
-    COGNITIVE_ABILITIES_STRING[LOW]: LOW,
-    COGNITIVE_ABILITIES_STRING[MEDIUM]: MEDIUM,
-    COGNITIVE_ABILITIES_STRING[HIGH]: HIGH
-}
+
+# per stage latency histograms
+from instrumentation import TIMINGS, ResponseTimer
+
+# shared constants and feature pipeline
+from constants import ID, QN, AN, AC, DF, INCORRECT, ID_, CORRECT, AN_, RS
+from constants import COGNITIVE_ABILITIES_STRING, LOW, MEDIUM, HIGH, DIFF_MAP
+from compiled_tree import Predictor
+from engine import TestSession
+from question_bank import QuestionBank
 
 # default font sizes
 TITLE_FONT_SIZE=48
@@ -63,51 +45,45 @@ BUTTON_FONT_SIZE=22
 class GUI:
 
     def __init__(self, 
-                 low_questions : List[Dict[str, Any]], 
-                 medium_questions : List[Dict[str, Any]], 
-                 high_questions : List[Dict[str, Any]],
-                 model
+                 question_bank : QuestionBank,
+                 model,
+                 predict_mode : str = "tree",
+                 policy = None,
+                 stopping = None
                 ):
 
-        # set questions
-        self.low_questions = low_questions
-        self.medium_questions = medium_questions
-        self.high_questions = high_questions
-
-        # shuffle questions
-        shuffle(self.low_questions)
-        shuffle(self.medium_questions)
-        shuffle(self.high_questions)
-
-        self.model = model # set model
-
-        # initalize values
-        self.X_all = []
-        self.determined = False
-        self.current_question = 0
-        self.score = 0          # not sure what to do with this rn
-        self.correct_count = 0  # not sure what to do with this rn
-        self.start_time = None
-        self.possible_score = 0 # not sure what to do with this rn
-        self.predicted_difficulty = "medium" # initial prediction, always medium
-
-        # results of answering a question(s)
-        self.answers_list = []
-        '''
-            Example of an entry in answers_list
-
-            answers_list[i] = {
-                "id": question_id, 
-                "selected_answer": selected_answer, 
-                "result": result, 
-                "difficulty": question[DF], 
-                "time_taken": time_taken
-            }
-        '''
+        # fast single answer inference, an existing Predictor is shared as is
+        self.predictor = model if isinstance(model, Predictor) else Predictor(model, predict_mode)
+        self.model = self.predictor.model # set model
+
+        # all test logic lives in the headless session, the GUI only displays it
+        # a compiled policy (policy.py) routes without the model
+        self.session = TestSession(question_bank, self.predictor, policy=policy, stopping=stopping)
+        self.timer = ResponseTimer() # paint -> click, on the monotonic clock
 
         self.root=tk.Tk()    # create Tkinter object
         self.root.withdraw() # hide main window
 
+    @property
+    def answers(self):
+        '''compact answer records, see answers.AnswerLog'''
+        return self.session.answers
+
+    @property
+    def answers_list(self) -> List[Dict[str, Any]]:
+        '''results of answering a question(s)'''
+        return self.session.answers_list
+
+    @property
+    def determined(self) -> bool:
+        '''True once a final cognitive ability was determined'''
+        return self.session.determined
+
+    @property
+    def predicted_difficulty(self) -> str:
+        '''latest cognitive ability prediction'''
+        return self.session.predicted_difficulty
+
     def start_test(self) -> None:
         '''Starts the cognitive ability test'''
 
@@ -189,7 +165,7 @@ class GUI:
         self.question_label.pack(expand=True, fill="both", padx=10, pady=10)
 
         # button grid to answer questions
-        self.button_grid = self.__ButtonGrid(self.root, self.__answer_selected)
+        self.button_grid = self.__ButtonGrid(self.root, self.__answer_selected, self.timer.pressed)
         self.button_grid_frame = self.button_grid.buttonframe
 
         self.__load_question() # load the first question
@@ -232,13 +208,15 @@ class GUI:
         while not self.username or self.username == "":
             self.username=simpledialog.askstring("Welcome", "Enter your first name:")
         self.username=self.username.lower() # set to lowercase for easier access
+        self.session.username=self.username
 
         logging.info(f"User: {self.username} started test.")
 
     def __load_question(self) -> None:
         '''Loads a question into window'''
 
-        self.start_time = time.time()
+        load_start = time.perf_counter_ns()
+        self.timer.loading()
 
         # retrieve values
         self.current_question_dir = self.__predict_and_get_next_question()
@@ -248,58 +226,40 @@ class GUI:
             return
 
         # update question counter
-        self.current_question += 1
-        self.counter_label.config(text=f"Question {self.current_question}")
+        widgets_start = time.perf_counter_ns()
+        self.counter_label.config(text=f"Question {self.session.question_count}")
         
         question_id = self.current_question_dir[ID] 
         question = self.current_question_dir[QN]
         choices = self.current_question_dir[AC]
 
-        logging.debug(f"Loading Question ID {question_id}: {question}") # print debug
+        log_start = time.perf_counter_ns()
+        logging.debug("Loading Question ID %s: %s", question_id, question) # formatted only if DEBUG
+        log_ns = time.perf_counter_ns() - log_start
 
         # set question and answers
         self.question_label.config(text=question)
         self.button_grid.set_answers(choices)
 
+        # draw now so the response clock starts when the question is visible
+        self.root.update_idletasks()
+        self.timer.shown()
+
+        end = time.perf_counter_ns()
+        TIMINGS.record("gui.log", log_ns)
+        TIMINGS.record("gui.widgets", end - widgets_start - log_ns)
+        TIMINGS.record("gui.load_question", end - load_start)
+
     def __predict_and_get_next_question(self) -> Optional[Dict[str, Any]]:
         ''' 
-            Predicts cognitive ability level ( LOW, MEDIUM, HIGH ) based on 
-            previous answer. Predicted cognitive ability level will then pop
-            the first question from the respective predicted cognitive ability
-            list and return it.
+            Gets the next question from the session, which predicts the
+            cognitive ability level from the previous answer, and shows
+            the new prediction.
         '''
 
-        # first question
-        if not self.answers_list:
-            return self.medium_questions.pop(0) \
-                if self.medium_questions else self.low_questions.pop(0) \
-                if self.low_questions else self.high_questions.pop(0) \
-                if self.high_questions else None
-        
-        # previous_answer
-        prev_answer = self.answers_list[-1]
-        X_tmp = [[
-            1 if prev_answer["result"] == CORRECT else INCORRECT,
-            prev_answer["difficulty"],
-            prev_answer["time_taken"]
-        ]]
-        # X = [[x[0], x[1], log(x[2] + 1)] for x in X_tmp] # normalize time
-        X = [[self.compute_weighted_correct(x[0], x[2]), x[1], log(x[2] + 1)] for x in X_tmp] # normalize time
-        self.X_all.extend(X) # extend total X data for final classification
-
-        prediction = self.model.predict(X)[0]  # returns "low", "medium", or "high"
-        self.predicted_difficulty = prediction # save prediction
-
+        question = self.session.next_question()
         self.cognitive_label.config(text=f"Cognitive Ability: {self.predicted_difficulty}")
-
-        if prediction == "low" and self.low_questions:
-            return self.low_questions.pop(0)
-        elif prediction == "medium" and self.medium_questions:
-            return self.medium_questions.pop(0)
-        elif prediction == "high" and self.high_questions:
-            return self.high_questions.pop(0)
-        else:
-            return None
+        return question
 
     def __answer_selected(self, chosen_idx : int) -> None:
         ''' 
@@ -307,8 +267,8 @@ class GUI:
             (user answers a questions).
         '''
 
-        end_time = time.time()
-        time_taken = end_time - self.start_time
+        click = time.perf_counter_ns()
+        time_taken, render_latency = self.timer.answered()
 
         question = self.current_question_dir 
         question_id = question[ID]
@@ -316,47 +276,27 @@ class GUI:
         selected_answer= self.button_grid.get_chosen_answer(chosen_idx) # collect answered value
         correct_answer = question[AN] # collect correct value
 
-        logging.info(f"Question ID: {question_id}\tAnswered: '{selected_answer}'\tAnswer: '{correct_answer}'") # print debug
+        log_start = time.perf_counter_ns()
+        logging.info("Question ID: %s\tAnswered: '%s'\tAnswer: '%s'", question_id, selected_answer, correct_answer) # print debug
+        TIMINGS.record("gui.log", time.perf_counter_ns() - log_start)
+
+        correct = self.session.submit_answer(selected_answer, time_taken, render_latency)
 
-        self.possible_score += question[DF] + 1
+        # feedback dialog waits on the user, so it is kept out of gui.answer
+        dialog_start = time.perf_counter_ns()
 
         # user's answer correct
-        if selected_answer == correct_answer:
-
-            self.correct_count += 1            # increment correct count
-            self.score += question[DF] * 2 + 1 # increase user's score
-            self.answers_list.append({
-                "id": question_id, 
-                "selected_answer": selected_answer, 
-                "result": CORRECT, 
-                "difficulty": question[DF], 
-                "time_taken": time_taken,
-                "predicted_difficulty": self.predicted_difficulty
-            })
+        if correct:
             messagebox.showinfo("Correct", "good job!")
 
         # user's answer incorrect
         else:
-
-            # remove 2 points if difficulty is low
-            if question[DF] == LOW:
-                self.score -= 2
-
-            # remove 1 point if difficulty is medium
-            elif question[DF] == MEDIUM:
-                self.score -= 1
-            
-            self.answers_list.append({
-                "id": question_id, 
-                "selected_answer": selected_answer, 
-                "result": INCORRECT, 
-                "difficulty": question[DF], 
-                "time_taken": time_taken,
-                "predicted_difficulty": self.predicted_difficulty
-            })
             messagebox.showwarning("Incorrect", f"The correct answer was {correct_answer}.")
+        dialog_ns = time.perf_counter_ns() - dialog_start
     
         self.__load_question() # load next question to window
+        TIMINGS.record("gui.dialog", dialog_ns)
+        TIMINGS.record("gui.answer", time.perf_counter_ns() - click - dialog_ns)
 
     def __show_message(self) -> None:
         '''
@@ -406,17 +346,9 @@ class GUI:
             between each question and returns the cognitive ability
             that was predicted most often.
         '''
-        predictions = self.model.predict(self.X_all)
-        prediction_counts = Counter(predictions)
-        print(f"Prediction Breakdown: {dict(prediction_counts)}")
-
-        most_common = prediction_counts.most_common(2)
-        if len(most_common) < 2 or most_common[0][1] > most_common[1][1]:
-            self.determined = True
-            return most_common[0][0].upper()
-        else:
-            self.determined = False
-            return "UNDETERMINED please take again."
+        final = self.session.final_result()
+        print(f"Prediction Breakdown: {dict(self.session.prediction_counts)}")
+        return final
         
     def __on_closing(self, window : tk.Tk) -> None:
         '''exit GUI & close window with prompt'''
@@ -439,15 +371,10 @@ class GUI:
         except Exception as e:
             logging.warning(f"Error: {e}")
 
-    def compute_weighted_correct(self, is_correct : int, time_taken : float) -> int:
-        if is_correct:
-            return 10 if time_taken < 6 else 7 if time_taken < 10 else 5 
-        return 0
-
     class __ButtonGrid:
         '''ButtonGrid class for multiple choice questions'''
         
-        def __init__(self, root, click_callback):
+        def __init__(self, root, click_callback, press_callback=None):
 
             # create buttonframe
             self.buttonframe=tk.Frame(root)
@@ -473,6 +400,8 @@ class GUI:
                         justify='center',
                         command=lambda idx=answer_idx: click_callback(idx)
                     )
+                    if press_callback is not None:
+                        btn.bind("<ButtonPress-1>", lambda event: press_callback(), add="+") # timestamp raw press
                     btn.grid(row=i,column=j,sticky='nsew', padx=5, pady=5)
                     row.append(btn)
                     answer_idx += 1
@@ -0,0 +1,83 @@
+# answers.py
+# Author: Andrew Kelton
+
+'''
+Compact per session answer storage.
+  * AnswerLog keeps a session's answers in one NumPy structured array
+    (the session log's ANSWER_DTYPE, render latency included) instead of
+    a dict per answer and a separate list of feature rows.
+  * The same array backs the feature matrix (features()), the persisted
+    record (persisted()) and, for older callers, the dict form (dicts()).
+  * Predicted labels are stored as int8 codes, see LABEL_CODES.
+'''
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+from features import build_features
+from session_log import ANSWER_DTYPE, NO_LABEL
+
+LABEL_CODES={label: code for code, label in enumerate(COGNITIVE_ABILITIES_STRING)} # "low" -> 0 ...
+INITIAL_CAPACITY=1 # records allocated by the first append, doubled when full
+_NO_RECORDS=np.empty(0, dtype=ANSWER_DTYPE) # shared by every log before its first answer
+
+
+class AnswerLog:
+    '''one session's answers, allocated on the first append and grown by doubling'''
+
+    __slots__ = ("records", "selected", "count", "last")
+
+    def __init__(self):
+        self.records = _NO_RECORDS
+        self.selected = []  # selected answers, references to the question's choices
+        self.count = 0
+        self.last = None    # (result, difficulty, time_taken) of the newest answer
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, question_id : int, selected_answer : Any, result : int, difficulty : int,
+               time_taken : float, render_latency : Optional[float], predicted : int) -> None:
+
+        if self.count == len(self.records):
+            grown = np.empty(max(INITIAL_CAPACITY, 2 * len(self.records)), dtype=ANSWER_DTYPE)
+            grown[:self.count] = self.records
+            self.records = grown
+
+        self.records[self.count] = (question_id, result, difficulty, time_taken, predicted,
+                                    np.nan if render_latency is None else render_latency)
+        self.selected.append(selected_answer)
+        self.count += 1
+        self.last = (result, difficulty, time_taken)
+
+    def view(self) -> np.ndarray:
+        '''the filled part of the records, no copy'''
+        return self.records[:self.count]
+
+    def features(self) -> np.ndarray:
+        '''feature matrix of every answer'''
+        answers = self.view()
+        return build_features(answers["result"], answers["difficulty"], answers["time_taken"])
+
+    def persisted(self) -> np.ndarray:
+        '''the answers as packed session log records, no copy'''
+        return self.view()
+
+    def dicts(self) -> List[Dict[str, Any]]:
+        '''answers in the old answers_list dict form'''
+
+        return [{
+            "id": int(a["id"]),
+            "selected_answer": selected,
+            "result": int(a["result"]),
+            "difficulty": int(a["difficulty"]),
+            "time_taken": float(a["time_taken"]),
+            "render_latency": None if np.isnan(a["render_latency"]) else float(a["render_latency"]),
+            "predicted_difficulty": COGNITIVE_ABILITIES_STRING[a["predicted"]] if a["predicted"] != NO_LABEL else None
+        } for a, selected in zip(self.view(), self.selected)]
+
+    def nbytes(self) -> int:
+        '''bytes held by the records array'''
+        return self.records.nbytes
@@ -0,0 +1,132 @@
+# background.py
+# Author: Andrew Kelton
+
+'''
+Background I/O so answer handling never waits on the disk or terminal.
+  * setup_logging routes every log record through a QueueHandler. A
+    QueueListener thread formats and writes them, so logging from the Tk
+    event loop or the server is a queue put.
+  * SessionWriter persists completed sessions on its own thread.
+  * Both report their lag: records or sessions still queued and how long
+    the oldest has waited.
+'''
+
+from typing import Any, Callable, Dict, Optional
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_FORMAT='%(asctime)s - %(levelname)s - %(message)s'
+DEFAULT_LOG_LEVEL=os.environ.get("COGNITIVE_LOG_LEVEL", "INFO") # production default
+
+
+class TimedQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that remembers when each record was queued'''
+
+    def prepare(self, record : logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.queued_at = time.perf_counter()
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+    '''QueueListener that tracks how far behind the writer thread is'''
+
+    def __init__(self, log_queue : queue.Queue, *handlers : logging.Handler):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.written = 0
+        self.max_lag_s = 0.0
+
+    def handle(self, record : logging.LogRecord) -> None:
+        super().handle(record)
+        self.written += 1
+        self.max_lag_s = max(self.max_lag_s, time.perf_counter() - getattr(record, "queued_at", time.perf_counter()))
+
+    def lag(self) -> Dict[str, Any]:
+        '''records waiting to be written and the worst wait so far'''
+        return {"pending": self.queue.qsize(), "written": self.written, "max_lag_s": self.max_lag_s}
+
+
+def setup_logging(level : str = DEFAULT_LOG_LEVEL, log_file : Optional[str] = None) -> LogListener:
+    '''
+        Sends all logging through a queue to a background writer. Returns
+        the started listener, stop() it on exit to flush what is left.
+    '''
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(TimedQueueHandler(log_queue))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = LogListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+class SessionWriter:
+    '''
+        Persists completed sessions on a background thread with save,
+        e.g. main.save_answers. submit never blocks the caller.
+    '''
+
+    def __init__(self, save : Callable[[Any], None]):
+
+        self.save = save
+        self.queue = queue.Queue()
+        self.written = 0
+        self.failed = 0
+        self.max_lag_s = 0.0
+        self.__oldest = None # queue time of the session being written
+
+        self.__thread = threading.Thread(target=self.__run, name="session-writer", daemon=True)
+        self.__thread.start()
+
+    def submit(self, session) -> None:
+        '''queues a finished session for saving'''
+        self.queue.put((time.perf_counter(), session))
+
+    def __run(self) -> None:
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            queued_at, session = item
+            self.__oldest = queued_at
+            try:
+                self.save(session)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logging.warning(f"Error: {e}, Saving session")
+            self.max_lag_s = max(self.max_lag_s, time.perf_counter() - queued_at)
+            self.__oldest = None
+
+    def lag(self) -> Dict[str, Any]:
+        '''sessions waiting to be saved and how long the current one has waited'''
+
+        oldest = self.__oldest
+        return {
+            "pending": self.queue.qsize(),
+            "written": self.written,
+            "failed": self.failed,
+            "current_wait_s": time.perf_counter() - oldest if oldest is not None else 0.0,
+            "max_lag_s": self.max_lag_s
+        }
+
+    def stop(self, timeout : Optional[float] = None) -> None:
+        '''saves everything still queued, then stops the thread'''
+        self.queue.put(None)
+        self.__thread.join(timeout)
@@ -0,0 +1,196 @@
+# batching.py
+# Author: Andrew Kelton
+
+'''
+Micro-batched predictions for the asyncio server.
+  * Every live session needs one prediction per answer. Instead of one
+    predict call per request, BatchScheduler collects the feature rows
+    of concurrent next-question requests and runs a single
+    predictor.predict over all of them.
+  * A batch is flushed when window_ms has passed since its first row or
+    when it holds max_batch rows, whichever comes first. A wider window
+    gives bigger batches (throughput) at the cost of waiting (latency).
+    window_ms 0 flushes on the next loop iteration, batching only what
+    arrived together.
+  * Batch sizes and the time each row waited are recorded, see stats()
+    and the batch.wait / batch.predict stages in instrumentation.
+'''
+
+from typing import Any, Dict, List, Sequence
+from collections import Counter
+from time import perf_counter_ns as clock
+import asyncio
+
+import numpy as np
+
+from instrumentation import Histogram, TIMINGS
+
+DEFAULT_WINDOW_MS=2.0
+DEFAULT_MAX_BATCH=64
+
+
+class BatchScheduler:
+    '''batches predict_one calls from many coroutines on one event loop'''
+
+    def __init__(self, predictor, window_ms : float = DEFAULT_WINDOW_MS, max_batch : int = DEFAULT_MAX_BATCH):
+
+        if window_ms < 0 or max_batch < 1:
+            raise ValueError("window_ms must be >= 0 and max_batch >= 1")
+
+        self.predictor = predictor # shared, may be swapped by online updates
+        self.window_s = window_ms / 1e3
+        self.max_batch = max_batch
+
+        self.rows : List[Sequence[float]] = []   # pending batch
+        self.futures : List[asyncio.Future] = []
+        self.queued_ns : List[int] = []
+        self.timer = None # flush scheduled for the pending batch
+
+        self.batches = 0
+        self.predictions = 0
+        self.full_batches = 0   # flushed because max_batch was reached
+        self.sizes = Counter()  # batch size -> batches
+        self.wait = Histogram() # queue wait of every row
+
+    async def predict_one(self, row : Sequence[float]) -> Any:
+        '''label for one feature row, predicted together with its batch'''
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.rows.append(row)
+        self.futures.append(future)
+        self.queued_ns.append(clock())
+
+        if len(self.rows) >= self.max_batch:
+            self.full_batches += 1
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window_s, self.flush)
+
+        return await future
+
+    def flush(self) -> None:
+        '''predicts every pending row and wakes up their callers'''
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.rows:
+            return
+
+        rows, futures, queued_ns = self.rows, self.futures, self.queued_ns
+        self.rows, self.futures, self.queued_ns = [], [], []
+
+        start = clock()
+        try:
+            labels = self.predictor.predict(np.asarray(rows, dtype=np.float64))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        end = clock()
+
+        for future, label, queued in zip(futures, labels.tolist(), queued_ns):
+            if not future.done(): # the request may have been cancelled meanwhile
+                future.set_result(label)
+            wait_ns = start - queued
+            self.wait.record(wait_ns)
+            TIMINGS.record("batch.wait", wait_ns)
+        TIMINGS.record("batch.predict", end - start)
+
+        self.batches += 1
+        self.predictions += len(rows)
+        self.sizes[len(rows)] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        '''batch size and queue wait metrics, waits in milliseconds'''
+
+        return {
+            "window_ms": self.window_s * 1e3,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "predictions": self.predictions,
+            "mean_batch_size": self.predictions / self.batches if self.batches else 0.0,
+            "full_batches": self.full_batches,
+            "batch_sizes": {str(size): n for size, n in sorted(self.sizes.items())},
+            "pending": len(self.rows),
+            "wait_p50_ms": self.wait.percentile(50) / 1e6,
+            "wait_p99_ms": self.wait.percentile(99) / 1e6,
+            "wait_max_ms": self.wait.max_ns / 1e6
+        }
+
+
+# ---- latency / throughput sweep ----
+
+async def _serve_and_load(test_server, port : int, sessions : int, concurrency : int) -> Dict[str, Any]:
+    '''serves on localhost while load_test drives it from the same loop'''
+    from server import load_test, DEFAULT_HOST
+
+    serving = asyncio.ensure_future(test_server.serve(DEFAULT_HOST, port))
+    await asyncio.sleep(0.05)
+    try:
+        report = await load_test(DEFAULT_HOST, port, sessions, concurrency)
+        await asyncio.sleep(0.05) # let the handlers see the clients disconnect
+        return report
+    finally:
+        serving.cancel()
+
+
+def sweep(question_bank, predictor, windows_ms : List[float], max_batch : int = DEFAULT_MAX_BATCH,
+          sessions : int = 1000, concurrency : int = 50, port : int = 8095) -> List[Dict[str, Any]]:
+    '''sessions/s and next-question latency without batching (None) and for every window'''
+
+    from server import TestServer
+
+    results = []
+    for window in [None] + list(windows_ms):
+        batcher = BatchScheduler(predictor, window, max_batch) if window is not None else None
+        report = asyncio.run(_serve_and_load(TestServer(question_bank, predictor, batcher=batcher),
+                                             port, sessions, concurrency))
+        next_route = report["server"]["routes"]["next"]
+        results.append({
+            "window_ms": window,
+            "sessions_per_s": report["client_sessions_per_s"],
+            "next_p50_ms": next_route["p50_ms"],
+            "next_p99_ms": next_route["p99_ms"],
+            "batching": report["server"].get("batching")
+        })
+        port += 1
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import logging
+    import main
+    from compiled_tree import Predictor, PREDICT_MODES
+
+    parser = argparse.ArgumentParser(description="Micro-batched prediction: throughput and latency per window")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5], help="windows in ms")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--predict-mode", choices=PREDICT_MODES, nargs="+", default=["sklearn", "tree"])
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    question_bank = main.get_question_bank("input/questions.json")
+    model = main.get_model()
+
+    report = {}
+    for mode in args.predict_mode:
+        report[mode] = sweep(question_bank, Predictor(model, mode), args.windows, args.max_batch,
+                             args.sessions, args.concurrency)
+        print(f"{mode:>8} {'window_ms':>10} {'sessions/s':>11} {'next p50':>9} {'next p99':>9} {'batch':>6} {'wait p99':>9}")
+        for r in report[mode]:
+            b = r["batching"] or {}
+            window = "off" if r["window_ms"] is None else f"{r['window_ms']:g}"
+            print(f"{'':>8} {window:>10} {r['sessions_per_s']:>11.0f} {r['next_p50_ms']:>9.3f} "
+                  f"{r['next_p99_ms']:>9.3f} {b.get('mean_batch_size', 1.0):>6.1f} {b.get('wait_p99_ms', 0.0):>9.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
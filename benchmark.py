@@ -0,0 +1,212 @@
+# benchmark.py
+# Author: Andrew Kelton
+
+'''
+End to end benchmark of the adaptive test with simulated examinees.
+  * Each examinee has a true ability (low/medium/high), answers correctly
+    with an item response style probability that depends on the gap
+    between ability and question difficulty, and takes a log-normal
+    amount of time that shrinks with ability.
+  * Sessions are driven through the headless TestSession engine with the
+    questions in input/questions.json.
+  * Reports throughput, per step latency percentiles, memory per session
+    and accuracy of the final result against the true ability.
+'''
+
+from typing import Any, Dict, List, Sequence
+from dataclasses import dataclass, field
+import math
+import random
+import time
+import tracemalloc
+
+from constants import COGNITIVE_ABILITIES_STRING, AN, AC, DF
+from engine import TestSession
+from question_bank import QuestionBank
+
+
+@dataclass
+class ExamineeConfig:
+    '''distribution of simulated examinees'''
+
+    ability_weights : Sequence[float] = (1.0, 1.0, 1.0)  # low, medium, high
+    ability_scale : Sequence[float] = (-1.0, 0.5, 2.0)   # theta of each ability
+    difficulty_scale : Sequence[float] = (-0.5, 0.75, 1.75) # b of each difficulty
+    discrimination : float = 2.0
+    median_time : float = 6.0   # seconds, for a medium examinee
+    time_sigma : float = 0.5    # log-normal sigma
+    time_ability_factor : float = 0.75 # each ability level multiplies time by this
+
+
+@dataclass
+class SimulatedExaminee:
+    ability : int
+    config : ExamineeConfig = field(default_factory=ExamineeConfig)
+
+    def p_correct(self, difficulty : int) -> float:
+        '''chance of answering a question of this difficulty correctly'''
+        c = self.config
+        gap = c.ability_scale[self.ability] - c.difficulty_scale[difficulty]
+        return 1 / (1 + math.exp(-c.discrimination * gap))
+
+    def answer(self, question : Dict[str, Any], rng : random.Random):
+        '''returns (selected answer, time taken) for a question'''
+
+        c = self.config
+        median = c.median_time * c.time_ability_factor ** (self.ability - 1)
+        time_taken = rng.lognormvariate(math.log(median), c.time_sigma)
+
+        if rng.random() < self.p_correct(question[DF]):
+            return question[AN], time_taken
+        wrong = [choice for choice in question[AC] if choice != question[AN]]
+        return rng.choice(wrong), time_taken
+
+
+def percentiles(samples : List[float], qs=(50, 90, 99)) -> Dict[str, float]:
+    '''nearest rank percentiles in microseconds'''
+
+    if not samples:
+        return {f"p{q}_us": 0.0 for q in qs}
+    ordered = sorted(samples)
+    return {f"p{q}_us": ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1e6 for q in qs}
+
+
+def measure_session_memory(question_bank : QuestionBank, predictor, n_sessions : int = 1000, answers : int = 5) -> float:
+    '''average bytes held by one live session after a few answers'''
+
+    rng = random.Random(0)
+    examinee = SimulatedExaminee(1)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = []
+    for _ in range(n_sessions):
+        session = TestSession(question_bank, predictor)
+        for _ in range(answers):
+            question = session.next_question()
+            if question is None:
+                break
+            session.submit_answer(*examinee.answer(question, rng))
+        sessions.append(session)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return used / n_sessions
+
+
+def run_benchmark(question_bank : QuestionBank, predictor, n_sessions : int = 10000,
+                  config : ExamineeConfig = None, seed : int = 0, policy = None, stopping = None) -> Dict[str, Any]:
+    '''
+        Runs n_sessions simulated tests back to back and returns a report of
+        throughput, step latencies and accuracy against the true abilities.
+        With a compiled policy the sessions route without the predictor,
+        with an engine.StoppingRule they may end early.
+    '''
+
+    config = config or ExamineeConfig()
+    rng = random.Random(seed)
+    abilities = rng.choices(range(len(COGNITIVE_ABILITIES_STRING)), weights=config.ability_weights, k=n_sessions)
+
+    next_times, answer_times, final_times = [], [], []
+    answers = correct = determined = stopped_early = 0
+    confusion = [[0] * (len(COGNITIVE_ABILITIES_STRING) + 1) for _ in COGNITIVE_ABILITIES_STRING]
+    clock = time.perf_counter
+
+    start = clock()
+    for ability in abilities:
+        examinee = SimulatedExaminee(ability, config)
+        session = TestSession(question_bank, predictor, policy=policy, stopping=stopping)
+
+        while True:
+            t0 = clock()
+            question = session.next_question()
+            next_times.append(clock() - t0)
+            if question is None:
+                break
+
+            selected, time_taken = examinee.answer(question, rng)
+            t0 = clock()
+            session.submit_answer(selected, time_taken)
+            answer_times.append(clock() - t0)
+            answers += 1
+
+        t0 = clock()
+        result = session.final_result()
+        final_times.append(clock() - t0)
+        stopped_early += session.stopped_early
+
+        # last column counts undetermined results
+        if session.determined:
+            determined += 1
+            predicted = COGNITIVE_ABILITIES_STRING.index(result.lower())
+            correct += predicted == ability
+        else:
+            predicted = len(COGNITIVE_ABILITIES_STRING)
+        confusion[ability][predicted] += 1
+    elapsed = clock() - start
+
+    return {
+        "sessions": n_sessions,
+        "answers": answers,
+        "elapsed_s": elapsed,
+        "sessions_per_s": n_sessions / elapsed,
+        "answers_per_s": answers / elapsed,
+        "answers_per_session": answers / n_sessions,
+        "latency": {
+            "next_question": percentiles(next_times),
+            "submit_answer": percentiles(answer_times),
+            "final_result": percentiles(final_times)
+        },
+        "accuracy": correct / n_sessions,
+        "determined_rate": determined / n_sessions,
+        "stopped_early_rate": stopped_early / n_sessions,
+        "confusion": {
+            COGNITIVE_ABILITIES_STRING[i]: dict(zip(COGNITIVE_ABILITIES_STRING + ["undetermined"], row))
+            for i, row in enumerate(confusion)
+        }
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import main
+    from compiled_tree import Predictor, PREDICT_MODES
+    from instrumentation import TIMINGS
+
+    parser = argparse.ArgumentParser(description="Benchmark the adaptive test with simulated examinees")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--predict-mode", default="tree", choices=PREDICT_MODES)
+    parser.add_argument("--ability-weights", type=float, nargs=3, default=(1.0, 1.0, 1.0),
+                        metavar=("LOW", "MEDIUM", "HIGH"))
+    parser.add_argument("--median-time", type=float, default=6.0, help="seconds, medium examinee")
+    parser.add_argument("--time-sigma", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--policy", metavar="PATH", default=None, help="route with a compiled policy")
+    parser.add_argument("--early-stop", action="store_true", help="end tests once the result cannot change")
+    parser.add_argument("--stop-confidence", type=float, default=None, help="also end tests at this confidence")
+    parser.add_argument("--min-answers", type=int, default=3)
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    question_bank = main.get_question_bank("input/questions.json")
+    predictor = Predictor(main.get_model(), args.predict_mode)
+    config = ExamineeConfig(ability_weights=args.ability_weights,
+                            median_time=args.median_time,
+                            time_sigma=args.time_sigma)
+
+    TIMINGS.reset()
+    policy = None
+    if args.policy:
+        from policy import Policy
+        policy = Policy.load(args.policy)
+    stopping = main.stopping_rule(args)
+    report = run_benchmark(question_bank, predictor, args.sessions, config, args.seed, policy, stopping)
+    report["stages"] = TIMINGS.summary()
+    report["memory_per_session_bytes"] = measure_session_memory(question_bank, predictor)
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,506 @@
+# compiled_tree.py
+# Author: Andrew Kelton
+
+'''
+Low latency inference for the fitted DecisionTreeClassifier.
+  * CompiledTree flattens tree_ into plain Python lists and walks it
+    directly, skipping sklearn's per call input validation. Its arrays
+    can be saved and reloaded without sklearn (main --fast-start).
+  * DecisionTable precomputes the label of every (weighted correctness,
+    difficulty, time bucket) cell so a prediction is one table index.
+  * PredictionCache memoizes single row predictions of tree models in a
+    bounded LRU keyed on (weighted correctness, difficulty, time bucket).
+  * Predictor picks the inference path, optionally behind the cache, and
+    recompiles (and empties the cache) whenever the model is refit.
+  * Running this file benchmarks the compiled path against model.predict.
+'''
+
+from typing import Any, Callable, Dict, Optional, Sequence
+from bisect import bisect_left
+from functools import lru_cache
+import threading
+import time
+
+import numpy as np
+
+from constants import LOW, MEDIUM, HIGH
+from features import WEIGHTED_CORRECT_VALUES
+
+TREE_LEAF=-1
+PREDICT_MODES=("sklearn", "tree", "table")
+DEFAULT_CACHE_SIZE=1024 # prediction cache entries, the bundled tree needs a few dozen
+
+# feature columns
+WEIGHT_COL, DIFFICULTY_COL, TIME_COL = 0, 1, 2
+DIFFICULTIES=(LOW, MEDIUM, HIGH)
+
+
+def float32_thresholds(threshold : np.ndarray) -> np.ndarray:
+    '''
+        sklearn casts X to float32 and goes left when float32(x) <= threshold.
+        Returns float64 thresholds T such that x <= T gives the same answer
+        for float64 x, so callers never have to cast.
+    '''
+
+    threshold = np.asarray(threshold, dtype=np.float64)
+
+    # largest float32 value not above the threshold
+    f32 = threshold.astype(np.float32)
+    f32 = np.where(f32.astype(np.float64) > threshold, np.nextafter(f32, np.float32(-np.inf)), f32)
+
+    # x rounds to f32 or below up to the midpoint with the next float32,
+    # the midpoint itself rounds to even
+    upper = np.nextafter(f32, np.float32(np.inf))
+    mid = (f32.astype(np.float64) + upper.astype(np.float64)) / 2
+    return np.where(mid.astype(np.float32) == f32, mid, np.nextafter(mid, -np.inf))
+
+
+def time_thresholds(feature : np.ndarray, left : np.ndarray, threshold : np.ndarray) -> np.ndarray:
+    '''sorted unique thresholds of the splits on the logged time'''
+
+    is_time_split = (np.asarray(feature) == TIME_COL) & (np.asarray(left) != TREE_LEAF)
+    return np.unique(np.asarray(threshold, dtype=np.float64)[is_time_split])
+
+
+class CompiledTree:
+    '''Flattened copy of a fitted decision tree'''
+
+    ARRAYS=("feature", "threshold", "left", "right", "node_label")
+
+    def __init__(self, model):
+
+        tree = model.tree_
+        self.source = tree # the sklearn tree this was compiled from
+
+        # label of every node, leaves are the only ones ever returned
+        node_class = np.argmax(tree.value[:, 0, :], axis=1)
+
+        self.__set_arrays(feature=tree.feature.astype(np.intp),
+                          threshold=float32_thresholds(tree.threshold),
+                          left=tree.children_left.astype(np.intp),
+                          right=tree.children_right.astype(np.intp),
+                          node_label=model.classes_[node_class])
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "CompiledTree":
+        '''rebuilds a tree saved with arrays(), sklearn is not needed'''
+
+        compiled = cls.__new__(cls)
+        compiled.source = None # no sklearn tree behind it
+        compiled.__set_arrays(**{name: np.asarray(arrays[name]) for name in cls.ARRAYS})
+        return compiled
+
+    def arrays(self) -> dict:
+        '''plain numpy arrays that fully describe the tree'''
+        arrays = {name: getattr(self, name + "_array") for name in self.ARRAYS}
+        arrays["node_label"] = arrays["node_label"].astype(str) # no pickled objects
+        return arrays
+
+    def __set_arrays(self, feature, threshold, left, right, node_label) -> None:
+
+        # numpy arrays for batches, views are kept as is (e.g. shared memory)
+        self.feature_array = feature.astype(np.intp, copy=False)
+        self.threshold_array = threshold.astype(np.float64, copy=False)
+        self.left_array = left.astype(np.intp, copy=False)
+        self.right_array = right.astype(np.intp, copy=False)
+        self.node_label_array = node_label
+
+        # python lists for single rows, indexing these is much cheaper than numpy
+        self.feature = self.feature_array.tolist()
+        self.threshold = self.threshold_array.tolist()
+        self.left = self.left_array.tolist()
+        self.right = self.right_array.tolist()
+        self.node_label = self.node_label_array.tolist()
+
+    def apply_one(self, row : Sequence[float]) -> int:
+        '''returns the leaf index reached by one feature row'''
+
+        feature, threshold, left, right = self.feature, self.threshold, self.left, self.right
+        node = 0
+        while left[node] != TREE_LEAF:
+            node = left[node] if row[feature[node]] <= threshold[node] else right[node]
+        return node
+
+    def predict_one(self, row : Sequence[float]) -> Any:
+        '''returns the label for one feature row'''
+        return self.node_label[self.apply_one(row)]
+
+    def apply(self, X : np.ndarray) -> np.ndarray:
+        '''returns the leaf index reached by every row of X, one tree level per step'''
+
+        X = np.asarray(X, dtype=np.float64)
+        rows = np.arange(X.shape[0])
+        nodes = np.zeros(X.shape[0], dtype=np.intp)
+
+        active = self.left_array[nodes] != TREE_LEAF
+        while active.any():
+            idx = rows[active]
+            n = nodes[idx]
+            go_left = X[idx, self.feature_array[n]] <= self.threshold_array[n]
+            nodes[idx] = np.where(go_left, self.left_array[n], self.right_array[n])
+            active = self.left_array[nodes] != TREE_LEAF
+        return nodes
+
+    def predict(self, X : np.ndarray) -> np.ndarray:
+        '''returns labels for every row of X'''
+        return self.node_label_array[self.apply(X)]
+
+
+class DecisionTable:
+    '''
+        Lookup table over the discrete feature space of a compiled tree.
+        Weighted correctness and difficulty only take a few values and the
+        logged time only matters relative to the tree's time thresholds,
+        so every input falls in one cell of table[weight][difficulty][bucket].
+        Rows outside that grid fall back to the compiled tree.
+    '''
+
+    def __init__(self, compiled : CompiledTree):
+
+        self.compiled = compiled
+        self.source = compiled.source
+
+        # time buckets, bucket b holds thresholds[b - 1] < t <= thresholds[b]
+        self.thresholds = time_thresholds(compiled.feature_array, compiled.left_array, compiled.threshold_array)
+        n_buckets = len(self.thresholds) + 1
+
+        self.weight_values = np.asarray(WEIGHTED_CORRECT_VALUES, dtype=np.float64)
+        self.weight_index = {w: i for i, w in enumerate(WEIGHTED_CORRECT_VALUES)}
+        self.difficulty_index = {d: i for i, d in enumerate(DIFFICULTIES)}
+
+        # walk the tree once per cell
+        self.table_array = np.empty((len(WEIGHTED_CORRECT_VALUES), len(DIFFICULTIES), n_buckets), dtype=np.intp)
+        for wi, weight in enumerate(WEIGHTED_CORRECT_VALUES):
+            for di, difficulty in enumerate(DIFFICULTIES):
+                for bucket in range(n_buckets):
+                    self.table_array[wi, di, bucket] = self._cell_leaf(weight, difficulty, bucket)
+
+        self.label_table_array = compiled.node_label_array[self.table_array]
+        self.threshold_list = self.thresholds.tolist()
+        self.label_table = self.label_table_array.tolist()
+
+    def _cell_leaf(self, weight : float, difficulty : int, bucket : int) -> int:
+        '''leaf reached by every row in one cell'''
+
+        c = self.compiled
+        row = (weight, difficulty)
+        node = 0
+        while c.left[node] != TREE_LEAF:
+            if c.feature[node] == TIME_COL:
+                # whole bucket is left of the split iff its upper bound is
+                go_left = bucket < len(self.thresholds) and self.thresholds[bucket] <= c.threshold[node]
+            else:
+                go_left = row[c.feature[node]] <= c.threshold[node]
+            node = c.left[node] if go_left else c.right[node]
+        return node
+
+    def predict_one(self, row : Sequence[float]) -> Any:
+        '''label for one feature row, one table index when on the grid'''
+
+        wi = self.weight_index.get(row[WEIGHT_COL])
+        di = self.difficulty_index.get(row[DIFFICULTY_COL])
+        if wi is None or di is None:
+            return self.compiled.predict_one(row)
+        return self.label_table[wi][di][bisect_left(self.threshold_list, row[TIME_COL])]
+
+    def predict(self, X : np.ndarray) -> np.ndarray:
+        '''labels for every row of X'''
+
+        X = np.asarray(X, dtype=np.float64)
+        wi = np.clip(np.searchsorted(self.weight_values, X[:, WEIGHT_COL]), 0, len(self.weight_values) - 1)
+        di = X[:, DIFFICULTY_COL].astype(np.intp)
+        on_grid = (self.weight_values[wi] == X[:, WEIGHT_COL]) \
+            & np.isin(X[:, DIFFICULTY_COL], DIFFICULTIES)
+
+        buckets = np.searchsorted(self.thresholds, X[:, TIME_COL], side="left")
+        labels = self.label_table_array[wi, np.where(on_grid, di, 0), buckets]
+
+        if not on_grid.all():
+            labels[~on_grid] = self.compiled.predict(X[~on_grid])
+        return labels
+
+
+class PredictionCache:
+    '''
+        Bounded LRU memo of single row predictions for a tree model.
+        Weighted correctness and difficulty are kept exactly, the logged
+        time is replaced by its bucket between the tree's time thresholds
+        (the float32 adjusted ones, so sklearn agrees). Every row of a
+        cell reaches the same leaf, so a hit is always the label the
+        model would have given. Misses predict the cell's upper bound.
+    '''
+
+    def __init__(self, max_size : int = 1024):
+
+        self.max_size = max_size
+        self.hits = 0            # of earlier fits, see stats()
+        self.misses = 0
+        self.invalidations = 0
+        self.bypassed = 0        # NaN times and models that are not trees, never cached
+        self.fit = None          # (fitted tree, uncached predict_one, cells) in use, replaced as a whole
+
+    def for_fit(self, predict_one : Callable[[Sequence[float]], Any], thresholds : Optional[np.ndarray],
+                fitted = None) -> tuple:
+        '''
+            An empty cache for one fit of the model, (fitted, predict_one,
+            cells) with cells None if thresholds is None (caching off).
+            Nothing is shared with the cache in use until install().
+        '''
+
+        if thresholds is None:
+            return (fitted, predict_one, None)
+
+        # bucket b holds thresholds[b - 1] < t <= thresholds[b], the last one is
+        # unbounded and represented by the next float above (sklearn refuses inf)
+        last = np.nextafter(thresholds[-1], np.inf) if len(thresholds) else 0.0
+        upper = thresholds.tolist() + [float(last)]
+
+        def predict_cell(weight : float, difficulty : float, bucket : int) -> Any:
+            return predict_one((weight, difficulty, upper[bucket]))
+
+        return (fitted, predict_one, (thresholds.tolist(), lru_cache(maxsize=self.max_size)(predict_cell)))
+
+    def install(self, fit : tuple) -> None:
+        '''makes fit (see for_fit) the one in use and adds up what the previous one served'''
+
+        previous, self.fit = self.fit, fit
+        if previous is not None and previous[2] is not None:
+            info = previous[2][1].cache_info()
+            self.hits += info.hits
+            self.misses += info.misses
+            self.invalidations += 1
+
+    def reset(self, predict_one : Callable[[Sequence[float]], Any], thresholds : Optional[np.ndarray],
+              fitted = None) -> None:
+        '''forgets every entry, for a new fit of the model. thresholds None turns caching off'''
+        self.install(self.for_fit(predict_one, thresholds, fitted))
+
+    def predict_one(self, row : Sequence[float], fit : Optional[tuple] = None) -> Any:
+        '''label for one row, through fit if given (see for_fit) else the one in use'''
+
+        _, predict, cells = fit or self.fit
+        time_taken = row[TIME_COL]
+        if cells is None or time_taken != time_taken: # NaN goes right at every split, no bucket for it
+            self.bypassed += 1
+            return predict(row)
+
+        thresholds, lookup = cells
+        return lookup(row[WEIGHT_COL], row[DIFFICULTY_COL], bisect_left(thresholds, time_taken))
+
+    def stats(self) -> Dict[str, Any]:
+        '''hit and miss counters over every fit so far'''
+
+        cells = self.fit[2] if self.fit is not None else None
+        info = cells[1].cache_info() if cells is not None else None
+        hits = self.hits + (info.hits if info else 0)
+        misses = self.misses + (info.misses if info else 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": info.currsize if info else 0,
+            "max_size": self.max_size,
+            "enabled": cells is not None,
+            "invalidations": self.invalidations,
+            "bypassed": self.bypassed
+        }
+
+
+class Predictor:
+    '''
+        Inference front end used by the GUI and engine. mode "sklearn" calls
+        model.predict, mode "tree" uses a CompiledTree and mode "table"
+        a DecisionTable. The compiled forms are rebuilt automatically
+        when the model is refit, and swap() replaces the model atomically
+        while sessions keep predicting. cache_size > 0 puts predict_one
+        of tree models behind a PredictionCache.
+    '''
+
+    def __init__(self, model, mode : str = "tree", cache_size : int = 0):
+
+        if mode not in PREDICT_MODES:
+            raise ValueError(f"Unknown predict mode '{mode}', expected one of {PREDICT_MODES}")
+
+        self.requested_mode = mode
+        self.version = 0
+        self.cache = PredictionCache(cache_size) if cache_size > 0 else None
+        self.lock = threading.Lock() # one swap at a time, predictions never take it
+        self.state = None            # (model, mode, compiled, cache fit), replaced as a whole
+        self.__publish(self.__build(model))
+
+    def __build(self, model) -> tuple:
+        '''compiles model for the requested mode, with an empty cache for it'''
+
+        # a precompiled tree (fast start) is used as is
+        if isinstance(model, CompiledTree):
+            mode = "tree" if self.requested_mode == "sklearn" else self.requested_mode
+            compiled = DecisionTable(model) if mode == "table" else model
+
+        # only single decision trees can be compiled
+        elif not hasattr(model, "tree_") or self.requested_mode == "sklearn":
+            mode, compiled = "sklearn", None
+
+        else:
+            mode, compiled = self.requested_mode, CompiledTree(model)
+            if mode == "table":
+                compiled = DecisionTable(compiled)
+
+        return (model, mode, compiled, self.__cache_fit(model, compiled))
+
+    def __cache_fit(self, model, compiled) -> Optional[tuple]:
+        '''empty PredictionCache fit for the model, only tree models are cached'''
+
+        if self.cache is None:
+            return None
+
+        if compiled is not None:
+            tree = compiled.compiled if isinstance(compiled, DecisionTable) else compiled
+            thresholds = time_thresholds(tree.feature_array, tree.left_array, tree.threshold_array)
+            return self.cache.for_fit(compiled.predict_one, thresholds, getattr(model, "tree_", None))
+        if hasattr(model, "tree_"):
+            tree = model.tree_
+            thresholds = time_thresholds(tree.feature, tree.children_left, float32_thresholds(tree.threshold))
+            return self.cache.for_fit(lambda row: model.predict([row])[0], thresholds, tree)
+        # e.g. a partial_fit linear model, updated in place and not piecewise constant
+        return self.cache.for_fit(lambda row: model.predict([row])[0], None)
+
+    def __publish(self, state : tuple) -> None:
+        '''puts a built state in use, the compiled model and its cache in one assignment'''
+
+        self.state = state
+        if self.cache is not None:
+            self.cache.install(state[3])
+
+    @staticmethod
+    def __stale(state : tuple) -> bool:
+        '''whether the model was refit in place since state was built'''
+
+        model, _, compiled, fit = state
+        tree = getattr(model, "tree_", None)
+        return (compiled is not None and compiled.source is not tree) or (fit is not None and fit[0] is not tree)
+
+    @property
+    def model(self):
+        return self.state[0]
+
+    @property
+    def mode(self) -> str:
+        return self.state[1]
+
+    def swap(self, model) -> None:
+        '''
+            Replaces the model. Compiling and the new empty cache are built
+            before the single state assignment, so concurrent predictions
+            see the old or the new model with its own cache, never a mix.
+        '''
+
+        state = self.__build(model)
+        with self.lock:
+            self.__publish(state)
+            self.version += 1
+
+    def __current(self) -> tuple:
+        '''the state in use, rebuilt once by whichever caller first notices an in place refit'''
+
+        state = self.state
+        if not self.__stale(state):
+            return state
+
+        with self.lock:
+            state = self.state
+            if self.__stale(state):
+                state = self.__build(state[0])
+                self.__publish(state)
+                self.version += 1
+        return state
+
+    def predict_one(self, row : Sequence[float]) -> Any:
+        '''label for a single feature row'''
+
+        model, mode, compiled, fit = self.state
+        if fit is not None:
+            if fit[0] is not getattr(model, "tree_", None): # refit in place, __stale inlined
+                model, mode, compiled, fit = self.__current()
+            return self.cache.predict_one(row, fit)
+        if compiled is not None and compiled.source is not getattr(model, "tree_", None):
+            model, mode, compiled, fit = self.__current()
+        if mode == "sklearn":
+            return model.predict([row])[0]
+        return compiled.predict_one(row)
+
+    def predict(self, X) -> np.ndarray:
+        '''labels for a batch of feature rows'''
+
+        model, mode, compiled, _ = self.__current()
+        if mode == "sklearn":
+            return model.predict(X)
+        return compiled.predict(X)
+
+
+def benchmark(model, X : np.ndarray, repeat : int = 2000) -> dict:
+    '''
+        Times single row inference of model.predict against the compiled
+        tree, the decision table and model.predict behind a PredictionCache
+        on rows of X and checks all four give identical labels.
+    '''
+
+    X = np.asarray(X, dtype=np.float64)
+    rows = X.tolist()
+    compiled = CompiledTree(model)
+    table = DecisionTable(compiled)
+    cached = Predictor(model, "sklearn", cache_size=DEFAULT_CACHE_SIZE)
+
+    # labels must match on every row, batch and single
+    expected = model.predict(X)
+    identical = all(
+        np.array_equal(expected, fast.predict(X))
+        and all(fast.predict_one(row) == label for row, label in zip(rows, expected))
+        for fast in (compiled, table)
+    ) and all(cached.predict_one(row) == label for row, label in zip(rows, expected))
+    cached.swap(model) # time from an empty cache
+
+    def per_call(fn) -> float:
+        start = time.perf_counter()
+        for i in range(repeat):
+            fn(rows[i % len(rows)])
+        return (time.perf_counter() - start) / repeat
+
+    sklearn_s = per_call(lambda row: model.predict([row])[0])
+    compiled_s = per_call(compiled.predict_one)
+    table_s = per_call(table.predict_one)
+    cached_s = per_call(cached.predict_one)
+
+    return {
+        "rows": len(rows),
+        "identical": identical,
+        "sklearn_us": sklearn_s * 1e6,
+        "compiled_us": compiled_s * 1e6,
+        "table_us": table_s * 1e6,
+        "cached_us": cached_s * 1e6,
+        "speedup": sklearn_s / compiled_s,
+        "table_speedup": sklearn_s / table_s,
+        "cached_speedup": sklearn_s / cached_s,
+        "cache": cached.cache.stats()
+    }
+
+
+if __name__ == '__main__':
+    import main
+
+    model = main.get_model()
+    X_train, _ = main.get_answers_to_X_y()
+
+    # training rows plus a dense grid over every discrete value and a range of times
+    grid = np.array([[w, d, t]
+                     for w in WEIGHTED_CORRECT_VALUES
+                     for d in range(3)
+                     for t in np.log1p(np.linspace(0, 30, 301))])
+    X = np.vstack([X_train, grid])
+
+    results = benchmark(model, X)
+    print(f"Rows checked: {results['rows']}, identical labels: {results['identical']}")
+    print(f"model.predict: {results['sklearn_us']:.1f} us/row")
+    print(f"compiled tree: {results['compiled_us']:.2f} us/row ({results['speedup']:.0f}x)")
+    print(f"decision table: {results['table_us']:.2f} us/row ({results['table_speedup']:.0f}x)")
+    print(f"cached predict: {results['cached_us']:.2f} us/row ({results['cached_speedup']:.0f}x), "
+          f"hit rate {results['cache']['hit_rate']:.1%}")
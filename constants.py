@@ -0,0 +1,28 @@
+# constants.py
+# Author: Andrew Kelton
+
+'''
+Constants shared by the GUI, the training code and the feature pipeline.
+'''
+
+# dictionary abbreviations of a question
+ID="id"
+QN="question"
+AN="answer"
+AC="answer choices"
+DF="difficulty"
+
+# indexes for variables in lists
+INCORRECT=ID_=0
+CORRECT=10
+AN_=1
+RS=2
+
+# cognitive ability levels & their mapping
+COGNITIVE_ABILITIES_STRING=["low", "medium", "high"]
+LOW, MEDIUM, HIGH = 0, 1, 2
+DIFF_MAP={
+    COGNITIVE_ABILITIES_STRING[LOW]: LOW,
+    COGNITIVE_ABILITIES_STRING[MEDIUM]: MEDIUM,
+    COGNITIVE_ABILITIES_STRING[HIGH]: HIGH
+}
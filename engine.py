@@ -0,0 +1,305 @@
+# engine.py
+# Author: Andrew Kelton
+
+'''
+Headless adaptive test engine.
+  * TestSession holds one examinee's questions, answers and predictions
+    and has no dependency on tkinter, so sessions can be driven by the
+    GUI, a server or a benchmark alike.
+  * Flow: next_question() -> submit_answer() -> ... -> final_result()
+  * With a compiled policy (policy.py) the routing and final result are
+    table lookups and the predictor is not used.
+  * Every prediction made between questions is tallied as it happens,
+    the final result is read off the tally. A StoppingRule can end the
+    test as soon as the result is settled.
+'''
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+from collections import Counter
+from statistics import NormalDist
+from time import perf_counter_ns as clock
+import math
+import random
+
+import numpy as np
+
+from answers import AnswerLog, LABEL_CODES
+from constants import ID, AN, DF, INCORRECT, CORRECT, LOW, MEDIUM, HIGH, COGNITIVE_ABILITIES_STRING
+from features import build_feature_row
+from instrumentation import TIMINGS
+from question_bank import QuestionBank
+
+UNDETERMINED="UNDETERMINED please take again."
+
+
+class StoppingRule:
+    '''
+        When a test may end before its pools run out, checked after every
+        prediction with the per label tally:
+          * always once the leading label is ahead of every other by more
+            than the questions left, the final result can no longer change
+          * with a confidence, also once min_answers were given and the
+            Wilson lower bound of the leader's share of the top two
+            labels is above one half at that (one sided) confidence
+    '''
+
+    __slots__ = ("confidence", "min_answers", "z")
+
+    def __init__(self, confidence : Optional[float] = None, min_answers : int = 3):
+
+        if confidence is not None and not 0.5 < confidence < 1:
+            raise ValueError("confidence must be between 0.5 and 1")
+
+        self.confidence = confidence
+        self.min_answers = min_answers
+        self.z = NormalDist().inv_cdf(confidence) if confidence is not None else None
+
+    def should_stop(self, tally : Sequence[int], answered : int, remaining : int) -> bool:
+        '''tally is the prediction count per label, remaining the most questions still to come'''
+
+        # the leader needs more than remaining to be decided, skip the sort when it can't be
+        if max(tally) <= remaining and (self.z is None or answered < self.min_answers):
+            return False
+
+        first, second = sorted(tally, reverse=True)[:2]
+        if first > second + remaining:
+            return True # decided
+        if self.z is None or answered < self.min_answers:
+            return False
+
+        n = first + second
+        p, z2 = first / n, self.z * self.z
+        lower = (p + z2 / (2 * n) - self.z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n))) / (1 + z2 / n)
+        return lower > 0.5
+
+
+class TestSession:
+
+    # fixed attributes, thousands of sessions may be live in one server
+    __slots__ = ("deck", "predictor", "policy", "username", "answers", "determined", "finished",
+                 "current_question", "question_count", "score", "correct_count",
+                 "possible_score", "predicted_code", "prediction_counts", "tally", "tallied",
+                 "stopping", "stopped_early")
+
+    def __init__(self,
+                 bank : QuestionBank,
+                 predictor,
+                 username : Optional[str] = None,
+                 rng : Optional[random.Random] = None,
+                 policy = None,
+                 stopping : Optional[StoppingRule] = None
+                ):
+
+        # shared read only bank, the session only keeps its own draw order
+        self.deck = bank.deck(rng)
+
+        self.predictor = predictor # shared, read only
+        self.policy = policy       # optional policy.Policy, replaces the predictor
+        self.stopping = stopping   # optional early end of the test
+        self.username = username
+
+        # initalize values
+        self.determined = False
+        self.finished = False
+        self.current_question = None
+        self.question_count = 0
+        self.score = 0
+        self.correct_count = 0
+        self.possible_score = 0
+        self.predicted_code = MEDIUM # initial prediction, always medium
+        self.prediction_counts = Counter()
+        self.tally = [0] * len(COGNITIVE_ABILITIES_STRING) # predictions per label code, as they are made
+        self.tallied = 0           # answers whose prediction is in the tally
+        self.stopped_early = False
+
+        # results of answering a question(s), one compact record per answer
+        # (id, result, difficulty, time_taken, predicted, render_latency),
+        # see answers.AnswerLog
+        self.answers = AnswerLog()
+
+    @property
+    def predicted_difficulty(self) -> str:
+        '''latest prediction as a label'''
+        return COGNITIVE_ABILITIES_STRING[self.predicted_code]
+
+    @property
+    def answers_list(self) -> List[Dict[str, Any]]:
+        '''
+            Answers in dict form, built on demand. Example of an entry
+
+            answers_list[i] = {
+                "id": question_id,
+                "selected_answer": selected_answer,
+                "result": result,
+                "difficulty": question[DF],
+                "time_taken": time_taken,         # seconds, question painted -> click
+                "render_latency": render_latency, # seconds, requested -> painted, None if unknown
+                "predicted_difficulty": predicted_difficulty
+            }
+        '''
+        return self.answers.dicts()
+
+    @property
+    def X_all(self) -> np.ndarray:
+        '''feature rows of every answer, for the final classification'''
+        return self.answers.features()
+
+    def pending_row(self) -> Optional[List[float]]:
+        '''
+            Feature row the next question will be predicted from, or None
+            if next_question() needs no prediction (first question, test
+            over, or a question is already waiting for its answer). Lets a
+            caller predict for many sessions at once, see batching.py.
+        '''
+
+        if self.finished or self.current_question is not None or not self.answers.count or self.policy is not None:
+            return None
+        return build_feature_row(*self.answers.last)
+
+    def next_question(self, prediction : Optional[str] = None) -> Optional[Mapping[str, Any]]:
+        '''
+            Predicts cognitive ability level ( LOW, MEDIUM, HIGH ) based on
+            previous answer. Predicted cognitive ability level will then draw
+            the next question from the respective predicted cognitive ability
+            pool and return it. Returns None when the test is over.
+
+            prediction, if given, is the label already predicted for
+            pending_row() and the session's predictor is not called.
+
+            Calling it again before an answer is submitted returns the
+            same question.
+        '''
+
+        if self.finished:
+            return None
+        if self.current_question is not None:
+            return self.current_question
+
+        start = clock()
+        question = self.__select_question(prediction)
+        TIMINGS.record("engine.next", clock() - start)
+        if question is None:
+            self.finished = True
+        else:
+            self.question_count += 1
+
+        self.current_question = question
+        return question
+
+    def __select_question(self, prediction : Optional[str]) -> Optional[Mapping[str, Any]]:
+        '''predicts from the last answer and draws from the predicted pool'''
+
+        deck = self.deck
+
+        # first question
+        if not self.answers.count:
+            return deck.draw(MEDIUM) \
+                if deck.remaining(MEDIUM) else deck.draw(LOW) \
+                if deck.remaining(LOW) else deck.draw(HIGH)
+
+        # previous_answer, unless the caller already predicted from it
+        if prediction is None and self.policy is not None:
+            prediction = self.policy.route(*self.answers.last)
+        elif prediction is None:
+            t0 = clock()
+            X = build_feature_row(*self.answers.last)
+            t1 = clock()
+            prediction = self.predictor.predict_one(X)  # returns "low", "medium", or "high"
+            TIMINGS.record("engine.features", t1 - t0)
+            TIMINGS.record("engine.predict", clock() - t1)
+
+        t2 = clock()
+        code = LABEL_CODES.get(prediction)
+        self.tallied = self.answers.count
+        if code is not None:
+            self.tally[code] += 1
+
+        # label codes are the pool difficulties, LOW=0 .. HIGH=2
+        if code is None:
+            question = None
+        elif self.stopping is not None and deck.remaining(code) and self.stopping.should_stop(
+                self.tally, self.answers.count, len(deck.bank) - self.question_count):
+            self.stopped_early = True
+            question = None
+        else:
+            self.predicted_code = code # save prediction
+            question = deck.draw(code)
+
+        TIMINGS.record("engine.draw", clock() - t2)
+        return question
+
+    def submit_answer(self, selected_answer : Any, time_taken : float,
+                      render_latency : Optional[float] = None) -> bool:
+        '''
+            Records the answer to the current question and updates the
+            score. Returns True if the answer was correct. time_taken is
+            the examinee's response time only, render_latency is how long
+            the client took to show the question, if it measured it.
+        '''
+
+        start = clock()
+        question = self.current_question
+        if question is None:
+            raise RuntimeError("No question to answer, call next_question() first")
+
+        self.possible_score += question[DF] + 1
+
+        # user's answer correct
+        correct = selected_answer == question[AN]
+        if correct:
+            self.correct_count += 1            # increment correct count
+            self.score += question[DF] * 2 + 1 # increase user's score
+
+        # user's answer incorrect
+        else:
+
+            # remove 2 points if difficulty is low
+            if question[DF] == LOW:
+                self.score -= 2
+
+            # remove 1 point if difficulty is medium
+            elif question[DF] == MEDIUM:
+                self.score -= 1
+
+        self.answers.append(question[ID], selected_answer, CORRECT if correct else INCORRECT,
+                            question[DF], time_taken, render_latency, self.predicted_code)
+
+        self.current_question = None
+        TIMINGS.record("engine.submit", clock() - start)
+        return correct
+
+    def final_result(self) -> str:
+        '''
+            Determine the user's overall cognitive ability.
+            Counts all predicted/selected cognitive abilities
+            between each question and returns the cognitive ability
+            that was predicted most often.
+
+            The counts come from the running tally, each answer counted
+            with the model that routed after it. Only answers that were
+            never followed by next_question() are predicted here.
+        '''
+
+        if self.tallied < self.answers.count:
+            answers = self.answers.view()[self.tallied:]
+            if self.policy is not None:
+                predictions = self.policy.route_many(answers["result"], answers["difficulty"], answers["time_taken"])
+            else:
+                predictions = self.predictor.predict(self.answers.features()[self.tallied:])
+            for prediction in predictions.tolist():
+                code = LABEL_CODES.get(prediction)
+                if code is not None:
+                    self.tally[code] += 1
+            self.tallied = self.answers.count
+
+        tally = self.tally
+        self.prediction_counts = Counter({label: n for label, n in zip(COGNITIVE_ABILITIES_STRING, tally) if n})
+
+        # a unique most predicted label
+        first, second = sorted(tally, reverse=True)[:2]
+        if first > second:
+            self.determined = True
+            return COGNITIVE_ABILITIES_STRING[tally.index(first)].upper()
+        else:
+            self.determined = False
+            return UNDETERMINED
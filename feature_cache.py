@@ -0,0 +1,275 @@
+# feature_cache.py
+# Author: Andrew Kelton
+
+'''
+Persistent columnar cache of the training features built from data/.
+  * X is kept as a float64 .npy matrix and y as int8 label codes.
+  * A manifest records which rows came from which answer file or
+    session log record, so each launch only parses files that are new
+    or changed and the part of the session log appended since.
+  * New rows are appended to the .npy files in place (write past the
+    end, patch the shape in the header), so an ingest costs O(new rows).
+    Only a removed or changed file, or a replaced log, rewrites the
+    arrays.
+'''
+
+from typing import Any, Callable, Dict, List, Tuple
+import json
+import os
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+from features import FEATURE_VERSION, N_FEATURES, build_features, label_codes
+from session_log import SessionLog, ANSWER_DTYPE, DEFAULT_LOG_PATH
+
+CACHE_FORMAT=3 # bump whenever the manifest layout changes
+CACHE_VERSION=[CACHE_FORMAT, FEATURE_VERSION]
+DEFAULT_CACHE_DIR="cache/features"
+
+X_FILE="X.npy"
+Y_FILE="y.npy"
+MANIFEST_FILE="manifest.json"
+LOG_NAME=os.path.basename(DEFAULT_LOG_PATH)
+
+
+def encode_labels(labels : List[str]) -> np.ndarray:
+    '''Turns "low"/"medium"/"high" labels into int8 codes'''
+    codes = {label: i for i, label in enumerate(COGNITIVE_ABILITIES_STRING)}
+    return np.fromiter((codes[label] for label in labels), dtype=np.int8, count=len(labels))
+
+def decode_labels(codes : np.ndarray) -> np.ndarray:
+    '''Turns int8 label codes back into label strings'''
+    return np.asarray(COGNITIVE_ABILITIES_STRING)[codes]
+
+
+def _read_manifest(cache_dir : str) -> Dict[str, Any]:
+    '''returns the manifest, empty if the cache is missing or stale'''
+
+    empty = {"files": {}, "log": {"ino": None, "offset": 0, "sessions": {}}, "rows": 0}
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return empty
+
+    if manifest.get("version") != CACHE_VERSION:
+        return empty
+
+    # an append interrupted between the arrays and the manifest leaves them out of step
+    try:
+        X, y = _load_arrays(cache_dir)
+        rows = (len(X), len(y))
+        X = y = None
+    except (OSError, ValueError):
+        return empty
+    if rows != (manifest["rows"], manifest["rows"]):
+        return empty
+    return manifest
+
+def _save_array(path : str, array : np.ndarray) -> None:
+    '''np.save through a temp file so readers never see a partial array'''
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+def _append_array(path : str, array : np.ndarray) -> bool:
+    '''
+        Appends rows to a C order .npy file in place: the data is written
+        past the end, then the shape in the header is patched. np.save pads
+        the header so the row count can grow. False if the file does not
+        fit array, nothing is written then.
+    '''
+
+    fmt = np.lib.format
+    with open(path, "r+b") as f:
+        version = fmt.read_magic(f)
+        if version not in ((1, 0), (2, 0)):
+            return False
+        header_start = f.tell() + (2 if version == (1, 0) else 4)
+        shape, fortran_order, dtype = fmt.read_array_header_1_0(f) if version == (1, 0) else fmt.read_array_header_2_0(f)
+        header_len = f.tell() - header_start
+        if fortran_order or dtype != array.dtype or tuple(shape[1:]) != array.shape[1:]:
+            return False
+
+        header = repr({"descr": fmt.dtype_to_descr(dtype), "fortran_order": False,
+                       "shape": (shape[0] + len(array),) + tuple(shape[1:])})
+        if len(header) + 1 > header_len:
+            return False
+
+        f.seek(header_start + header_len + shape[0] * dtype.itemsize * int(np.prod(shape[1:])))
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate()
+        f.seek(header_start)
+        f.write((header.ljust(header_len - 1) + "\n").encode("latin-1"))
+    return True
+
+def _write_manifest(cache_dir : str, manifest : Dict[str, Any]) -> None:
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        f.write(json.dumps(dict(manifest, version=CACHE_VERSION))) # dumps uses the C encoder, dump does not
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def _write_cache(cache_dir : str, X : np.ndarray, y : np.ndarray, manifest : Dict[str, Any]) -> None:
+    '''writes arrays first and the manifest last'''
+
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_array(os.path.join(cache_dir, X_FILE), X)
+    _save_array(os.path.join(cache_dir, Y_FILE), y)
+    _write_manifest(cache_dir, manifest)
+
+def _append_cache(cache_dir : str, X : np.ndarray, y : np.ndarray, manifest : Dict[str, Any]) -> bool:
+    '''appends rows to the cached arrays and then writes the manifest, False if they could not be appended'''
+
+    if not _append_array(os.path.join(cache_dir, X_FILE), X):
+        return False
+    if not _append_array(os.path.join(cache_dir, Y_FILE), y):
+        return False # X grew alone, the rewrite that follows replaces it
+    _write_manifest(cache_dir, manifest)
+    return True
+
+def session_ranges(cache_dir : str = DEFAULT_CACHE_DIR) -> List[Tuple[str, int, int]]:
+    '''
+        (session name, start row, stop row) of every cached session in row
+        order. JSON sessions are named by file, logged ones "sessions.log:<id>".
+    '''
+
+    manifest = _read_manifest(cache_dir)
+    ranges = [(name, e["start"], e["stop"]) for name, e in manifest["files"].items()]
+    ranges += [(f"{LOG_NAME}:{sid}", e["start"], e["stop"]) for sid, e in manifest["log"]["sessions"].items()]
+    return sorted(ranges, key=lambda r: r[1])
+
+def _load_arrays(cache_dir : str) -> Tuple[np.ndarray, np.ndarray]:
+    '''memory maps the cached arrays'''
+    X = np.load(os.path.join(cache_dir, X_FILE), mmap_mode="r")
+    y = np.load(os.path.join(cache_dir, Y_FILE), mmap_mode="r")
+    return X, y
+
+
+def log_rows(records : list) -> Tuple[np.ndarray, np.ndarray]:
+    '''features and label codes for a batch of session log records, in one pass'''
+
+    answers = np.concatenate([r.answers for r in records]) if records else np.empty(0, dtype=ANSWER_DTYPE)
+    X = build_features(answers["result"], answers["difficulty"], answers["time_taken"])
+    return X, label_codes(X)
+
+def load_X_y(parse_file : Callable[[str], Tuple[np.ndarray, np.ndarray]],
+             folder_path : str = "data",
+             cache_dir : str = DEFAULT_CACHE_DIR
+            ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        Returns (X, y) for every answer file in folder_path and every session
+        in its session log. Files whose size and mtime match the manifest are
+        taken from the cache, the rest are parsed with
+        parse_file(file_path) -> (X, label codes). The log is only read from
+        the offset ingested last time. When nothing changed the arrays are
+        memory mapped straight from disk.
+    '''
+
+    manifest = _read_manifest(cache_dir)
+    files_old, log_old = manifest["files"], manifest["log"]
+
+    # stat all answer files
+    current = {}
+    for filename in sorted(os.listdir(folder_path)):
+        if filename.endswith(".json"):
+            stat = os.stat(os.path.join(folder_path, filename))
+            current[filename] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def unchanged(filename : str) -> bool:
+        entry = files_old.get(filename)
+        return entry is not None \
+            and entry["size"] == current[filename]["size"] \
+            and entry["mtime_ns"] == current[filename]["mtime_ns"]
+
+    kept = [f for f in current if unchanged(f)]
+    parse = [f for f in current if not unchanged(f)]
+    removed = [f for f in files_old if f not in current]
+
+    # the log only grows, a missing, shrunk or replaced log is read again from the start
+    log = SessionLog(os.path.join(folder_path, LOG_NAME))
+    log_stat = os.stat(log.path) if os.path.exists(log.path) else None
+    log_kept = log_stat is not None and log_stat.st_ino == log_old["ino"] and log_stat.st_size >= log_old["offset"]
+    log_start = log_old["offset"] if log_kept else 0
+
+    new_records, log_offset = [], log_start
+    if log_stat is not None and log_stat.st_size > log_start:
+        for record, end in log.scan_with_offsets(log_start):
+            new_records.append(record)
+            log_offset = end
+
+    # nothing new, serve cache as is
+    if os.path.exists(os.path.join(cache_dir, MANIFEST_FILE)) and not parse and not removed \
+            and not new_records and (log_kept or not log_old["sessions"]):
+        return _load_arrays(cache_dir)
+
+    # rows of new or changed files and new log sessions, ranges counted from 0
+    X_parts, y_parts = [], []
+    new_files, new_sessions = {}, {}
+    rows = 0
+
+    for filename in parse:
+        X_file, y_file = parse_file(os.path.join(folder_path, filename))
+        X_parts.append(np.asarray(X_file, dtype=np.float64).reshape(-1, N_FEATURES))
+        y_parts.append(np.asarray(y_file, dtype=np.int8))
+        new_files[filename] = dict(current[filename], start=rows, stop=rows + len(y_file))
+        rows += len(y_file)
+
+    # new log sessions, featurized together
+    if new_records:
+        X_log, y_log = log_rows(new_records)
+        X_parts.append(X_log)
+        y_parts.append(y_log)
+        for record in new_records:
+            new_sessions[record.session_id] = {"start": rows, "stop": rows + len(record.answers)}
+            rows += len(record.answers)
+
+    X_new = np.concatenate(X_parts) if X_parts else np.empty((0, N_FEATURES), dtype=np.float64)
+    y_new = np.concatenate(y_parts) if y_parts else np.empty(0, dtype=np.int8)
+    log_entry = {
+        "ino": log_stat.st_ino if log_stat is not None else None,
+        "offset": log_offset if log_stat is not None else 0
+    }
+
+    def shifted(entries : Dict[str, Any], by : int) -> Dict[str, Any]:
+        return {key: dict(e, start=e["start"] + by, stop=e["stop"] + by) for key, e in entries.items()}
+
+    # nothing removed or changed: append the new rows in place, O(new rows)
+    if manifest["rows"] and not removed and not any(f in files_old for f in parse) \
+            and (log_kept or not log_old["sessions"]):
+        old_rows = manifest["rows"]
+        if _append_cache(cache_dir, X_new, y_new, {
+            "files": dict(files_old, **shifted(new_files, old_rows)),
+            "log": dict(log_entry, sessions=dict(log_old["sessions"], **shifted(new_sessions, old_rows))),
+            "rows": old_rows + len(y_new)
+        }):
+            return _load_arrays(cache_dir)
+
+    # otherwise rewrite: the rows still in use, compacted, then the new ones
+    X_parts, y_parts = [], []
+    X_old = y_old = None
+    files, sessions = {}, {}
+    rows = 0
+
+    old_ranges = [(files, f, files_old[f]) for f in kept]
+    if log_kept:
+        old_ranges += [(sessions, sid, e) for sid, e in log_old["sessions"].items()]
+
+    if old_ranges:
+        X_old, y_old = _load_arrays(cache_dir)
+        for target, key, entry in sorted(old_ranges, key=lambda r: r[2]["start"]):
+            start, stop = entry["start"], entry["stop"]
+            X_parts.append(X_old[start:stop])
+            y_parts.append(y_old[start:stop])
+            target[key] = dict(entry, start=rows, stop=rows + stop - start)
+            rows += stop - start
+
+    files.update(shifted(new_files, rows))
+    sessions.update(shifted(new_sessions, rows))
+    X = np.concatenate(X_parts + [X_new])
+    y = np.concatenate(y_parts + [y_new])
+    # drop every reference to the memory maps (the slices too) before replacing the files
+    X_parts = y_parts = X_old = y_old = None
+
+    _write_cache(cache_dir, X, y, {"files": files, "log": dict(log_entry, sessions=sessions), "rows": len(y)})
+    return X, y
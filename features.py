@@ -0,0 +1,101 @@
+# features.py
+# Author: Andrew Kelton
+
+'''
+Feature pipeline shared by training and inference.
+  * Turns arrays of (result, difficulty, time_taken) into the model's
+    feature matrix [Weighted Correctness, Difficulty, Logged Time Taken].
+  * Works on whole batches and on single answers alike, so the
+    training data and the live predictions can never drift apart.
+'''
+
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from constants import INCORRECT, CORRECT, MEDIUM, LOW, HIGH
+
+FEATURES=['Weighted Correctness', 'Difficulty', 'Logged Time Taken']
+FEATURE_VERSION=2 # bump whenever the transform changes, invalidates caches and models
+N_FEATURES=len(FEATURES)
+
+# weighted correctness by speed, seconds
+FAST_TIME=6
+SLOW_TIME=10
+FAST_WEIGHT, MEDIUM_WEIGHT, SLOW_WEIGHT = CORRECT, 7, 5
+WEIGHTED_CORRECT_VALUES=(INCORRECT, SLOW_WEIGHT, MEDIUM_WEIGHT, FAST_WEIGHT)
+
+
+def weighted_correct(result, time_taken) -> np.ndarray:
+    '''
+        Weighted correctness of answers, 0 if wrong else 10/7/5 
+        for answers under 6s/under 10s/slower.
+    '''
+
+    is_correct = np.asarray(result) != INCORRECT
+    time_taken = np.asarray(time_taken, dtype=np.float64)
+
+    return np.select(
+        [~is_correct, time_taken < FAST_TIME, time_taken < SLOW_TIME],
+        [INCORRECT, FAST_WEIGHT, MEDIUM_WEIGHT],
+        default=SLOW_WEIGHT
+    )
+
+def build_features(result, difficulty, time_taken) -> np.ndarray:
+    '''
+        Returns the (n, 3) feature matrix for n answers. Scalars are
+        treated as a single answer and give a (1, 3) matrix.
+    '''
+
+    time_taken = np.atleast_1d(np.asarray(time_taken, dtype=np.float64))
+
+    X = np.empty((time_taken.shape[0], N_FEATURES), dtype=np.float64)
+    X[:, 0] = weighted_correct(np.atleast_1d(result), time_taken)
+    X[:, 1] = np.atleast_1d(difficulty)
+    X[:, 2] = np.log1p(time_taken) # normalize time with log
+    return X
+
+def build_feature_row(result : int, difficulty : int, time_taken : float) -> List[float]:
+    '''Single answer fast path, same values as build_features without array overhead'''
+
+    if result == INCORRECT:
+        weighted = INCORRECT
+    else:
+        weighted = FAST_WEIGHT if time_taken < FAST_TIME else MEDIUM_WEIGHT if time_taken < SLOW_TIME else SLOW_WEIGHT
+    return [weighted, difficulty, float(np.log1p(time_taken))]
+
+def label_codes(X : np.ndarray) -> np.ndarray:
+    '''
+        True cognitive ability label code of each feature row, based on
+        actual performance: fast correct medium/high answers are high,
+        other fast correct answers medium, everything else low.
+    '''
+
+    X = np.asarray(X)
+    fast_correct = X[:, 0] == CORRECT
+    return np.select(
+        [fast_correct & (X[:, 1] >= MEDIUM), fast_correct],
+        [HIGH, MEDIUM],
+        default=LOW
+    ).astype(np.int8)
+
+def answers_to_columns(answers : List[Dict[str, Any]], source : str = "") -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+        Pulls (result, difficulty, time_taken) columns out of answer dicts,
+        skipping entries that are missing or malformed.
+    '''
+
+    result, difficulty, time_taken = [], [], []
+    for answer in answers:
+        try:
+            row = (int(answer['result']), int(answer['difficulty']), float(answer['time_taken']))
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Skipping bad entry in {source}: {e}")
+            continue
+        result.append(row[0])
+        difficulty.append(row[1])
+        time_taken.append(row[2])
+
+    return (np.asarray(result, dtype=np.int64),
+            np.asarray(difficulty, dtype=np.int64),
+            np.asarray(time_taken, dtype=np.float64))
@@ -0,0 +1,217 @@
+# instrumentation.py
+# Author: Andrew Kelton
+
+'''
+Per stage latency instrumentation for the adaptive loop.
+  * Stages are timed with time.perf_counter_ns and recorded into log
+    scale histograms (4 buckets per power of two, about 19% wide), so
+    recording is a few integer operations and memory is fixed however
+    long the process runs. Cheap enough to leave on in production.
+  * Stages of one answer:
+      gui.answer          click -> next question shown
+        engine.submit     scoring the answer
+        gui.load_question next question -> widgets updated
+          engine.next     features + predict + draw
+            engine.features, engine.predict, engine.draw
+          gui.widgets     label and button updates
+          gui.render      next question requested -> painted
+      gui.log             log calls on the click path
+  * Histograms export as JSON or CSV. profile() wraps any block in an
+    optional cProfile dump.
+  * ResponseTimer measures an examinee's response time from the moment a
+    question is painted to the moment the click arrives, on the monotonic
+    clock, with the render latency kept separately.
+'''
+
+from typing import Any, Dict, Iterator, Optional, Tuple
+from contextlib import contextmanager
+import csv
+import json
+import os
+import threading
+import time
+
+SUB_BUCKETS=4 # per power of two
+N_BUCKETS=65 * SUB_BUCKETS # up to 64 bit durations
+
+
+def bucket_of(ns : int) -> int:
+    '''histogram bucket of a duration in nanoseconds'''
+
+    bits = ns.bit_length()
+    if bits <= 2:
+        return ns
+    return (bits << 2) | ((ns >> (bits - 3)) & 3)
+
+def bucket_upper(index : int) -> int:
+    '''largest duration in nanoseconds that falls in a bucket'''
+
+    bits, sub = index >> 2, index & 3
+    if bits == 0:
+        return index
+    return ((4 | sub) + 1 << (bits - 3)) - 1 if bits >= 3 else index
+
+
+class Histogram:
+    '''fixed size log scale latency histogram'''
+
+    __slots__ = ("counts", "count", "total_ns", "min_ns", "max_ns")
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def record(self, ns : int) -> None:
+        bits = ns.bit_length() # bucket_of, inlined
+        self.counts[(bits << 2) | ((ns >> (bits - 3)) & 3) if bits > 2 else ns] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        if self.min_ns is None or ns < self.min_ns:
+            self.min_ns = ns
+
+    def percentile(self, q : float) -> int:
+        '''upper bound in nanoseconds of the q-th percentile bucket'''
+
+        if not self.count:
+            return 0
+        rank = max(1, int(q / 100 * self.count + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bucket_upper(index), self.max_ns)
+        return self.max_ns
+
+    def summary(self) -> Dict[str, float]:
+        '''count, mean and percentiles in microseconds'''
+
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1e3 if self.count else 0.0,
+            "min_us": (self.min_ns or 0) / 1e3,
+            "p50_us": self.percentile(50) / 1e3,
+            "p90_us": self.percentile(90) / 1e3,
+            "p99_us": self.percentile(99) / 1e3,
+            "max_us": self.max_ns / 1e3
+        }
+
+    def buckets(self) -> Dict[str, int]:
+        '''non empty buckets as upper bound in ns -> count'''
+        return {str(bucket_upper(i)): n for i, n in enumerate(self.counts) if n}
+
+
+class StageTimings:
+    '''one histogram per named stage'''
+
+    def __init__(self, enabled : bool = True):
+        self.enabled = enabled
+        self.stages : Dict[str, Histogram] = {}
+        self.lock = threading.Lock() # only taken to add a new stage
+
+    def record(self, stage : str, ns : int) -> None:
+        '''records one duration in nanoseconds'''
+
+        if self.enabled:
+            try:
+                self.stages[stage].record(ns)
+            except KeyError:
+                with self.lock:
+                    self.stages.setdefault(stage, Histogram()).record(ns)
+
+    @contextmanager
+    def time(self, stage : str) -> Iterator[None]:
+        '''times a with block, for code off the hot path'''
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter_ns() - start)
+
+    def reset(self) -> None:
+        self.stages = {}
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {stage: h.summary() for stage, h in sorted(self.stages.items())}
+
+    def export(self, path : str) -> None:
+        '''writes the histograms as CSV if path ends with .csv, otherwise JSON'''
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["stage", "count", "mean_us", "min_us", "p50_us", "p90_us", "p99_us", "max_us"])
+                for stage, s in self.summary().items():
+                    writer.writerow([stage] + [s[key] for key in ("count", "mean_us", "min_us", "p50_us",
+                                                                  "p90_us", "p99_us", "max_us")])
+        else:
+            report = {stage: dict(h.summary(), buckets_ns=h.buckets()) for stage, h in sorted(self.stages.items())}
+            with open(path, "w") as f:
+                json.dump(report, f, indent=4)
+
+
+TIMINGS=StageTimings() # process wide, shared by the engine, GUI and server
+
+
+class ResponseTimer:
+    '''
+        Monotonic response timing for one question at a time:
+        loading() when the next question is requested, shown() once it is
+        painted, pressed() on the raw mouse press, then answered() when the
+        answer callback runs. Time spent rendering or in dialogs is never
+        counted as the examinee's.
+    '''
+
+    __slots__ = ("load_ns", "shown_ns", "pressed_ns")
+
+    def __init__(self):
+        self.load_ns = self.shown_ns = self.pressed_ns = None
+
+    def loading(self) -> None:
+        self.load_ns = time.perf_counter_ns()
+        self.shown_ns = self.pressed_ns = None
+
+    def shown(self) -> None:
+        self.shown_ns = time.perf_counter_ns()
+        TIMINGS.record("gui.render", self.render_ns())
+
+    def pressed(self) -> None:
+        '''first press after the question is shown wins'''
+        if self.shown_ns is not None and self.pressed_ns is None:
+            self.pressed_ns = time.perf_counter_ns()
+
+    def render_ns(self) -> int:
+        '''question requested -> painted'''
+        return self.shown_ns - self.load_ns if self.shown_ns is not None and self.load_ns is not None else 0
+
+    def answered(self) -> Tuple[float, float]:
+        '''(response time, render latency) in seconds for the shown question'''
+
+        clicked = self.pressed_ns if self.pressed_ns is not None else time.perf_counter_ns()
+        response_ns = clicked - self.shown_ns if self.shown_ns is not None else 0
+        return max(response_ns, 0) / 1e9, self.render_ns() / 1e9
+
+
+@contextmanager
+def profile(path : Optional[str]) -> Iterator[Any]:
+    '''runs the block under cProfile and dumps the stats to path, no-op without a path'''
+
+    if not path:
+        yield None
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(path)
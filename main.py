@@ -1,32 +1,44 @@
 # main.py
 # Author: Andrew Kelton
 
-# import my gui
-import GUI as gui
-
-# import DT modules
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import classification_report
-from sklearn.model_selection import cross_val_score
+# the GUI (tkinter) and sklearn are imported where they are used, so a
+# fast start with a compiled model never loads them, see startup_benchmark.py
+
+# import model persistence
+import model_store
+import background
+import instrumentation
+import feature_cache
+from session_log import SessionLog
+from question_bank import QuestionBank, load_question_bank
+import features
+from compiled_tree import PREDICT_MODES, DEFAULT_CACHE_SIZE, CompiledTree
+from constants import LOW, MEDIUM, HIGH
 
 import numpy as np
+from typing import Optional, TYPE_CHECKING
+import argparse
+import logging
 import json
 import sys
+import os
+
+if TYPE_CHECKING:
+    from sklearn.tree import DecisionTreeClassifier
 
-FEATURES=['Weighted Correctness', 'Difficulty', 'Logged Time Taken']
+FEATURES=features.FEATURES
+session_log=SessionLog() # completed tests, data/sessions.log
 LINE="------------------------------------------------------------------------------------------------\n"
 
 # dummy training data, or control data
 dummy_X = [
-    [10, gui.LOW, 4.0],
-    [10, gui.MEDIUM, 4.0],
-    [10, gui.HIGH, 4.0],
+    [10, LOW, 4.0],
+    [10, MEDIUM, 4.0],
+    [10, HIGH, 4.0],
 
-    [0, gui.LOW, 4.0],
-    [0, gui.MEDIUM, 4.0],
-    [0, gui.HIGH, 4.0]
+    [0, LOW, 4.0],
+    [0, MEDIUM, 4.0],
+    [0, HIGH, 4.0]
 ]
 # result of answer
 dummy_y = [
@@ -39,11 +51,6 @@ dummy_y = [
     "medium"   # wrong HIGH → tried hard, but maybe not lowest
 ]
 
-def compute_weighted_correct(is_correct : int, time_taken : float) -> int:
-    if is_correct:
-        return 10 if time_taken < 6 else 7 if time_taken < 10 else 5 
-    return 0
-
 def read_json(file_name : str):
     '''reads and returns contents of json file'''
     with open(file_name, "r") as jf:
@@ -54,61 +61,69 @@ def get_questions(file_name : str):
         a triple of lists containing low-high questions.
     '''
 
-    data = read_json(file_name)
+    bank = get_question_bank(file_name)
+    return bank.pool_questions(LOW), bank.pool_questions(MEDIUM), bank.pool_questions(HIGH)
+
+def get_question_bank(file_name : str) -> QuestionBank:
+    '''
+        Read questions into the shared, read only question bank. JSON Lines
+        files (.jsonl) are indexed and loaded lazily.
+    '''
+    return load_question_bank(file_name)
+
+
+def read_answers_file(file_path : str):
+    ''' 
+        Reads answers from one previous test and turns them to the 
+        true value to label y. Returns tuple of X matrix, y label codes.
+    '''
 
-    # convert difficulties to ints
-    for ability, question_list in data.items():
-        for q in question_list:
-            q["difficulty"]=gui.DIFF_MAP[q["difficulty"]]
+    try:
+        data = read_json(file_path)
+    except Exception as e:
+        print(f"Error: {e}, Reading: {file_path}", sys.stderr)
+        data = []
 
-    return data["low"], data["medium"], data["high"]
+    # read answer data, then build features and labels for all answers at once
+    result, difficulty, time_taken = features.answers_to_columns(data, os.path.basename(file_path))
+    X = features.build_features(result, difficulty, time_taken)
 
+    # assign label based on actual performance, not prediction
+    return X, features.label_codes(X)
 
-def get_answers_to_X_y(folder_path: str = "data"):
+def get_answers_to_X_y(folder_path: str = "data", use_cache : bool = True):
     ''' 
-        Reads answers from previous tests in data folder and 
-        turns them to the true value to label y. Returns
-        tuple of prepared X, y training data set for model.
+        Reads answers from previous tests in data folder and its
+        session log and turns them to the true value to label y.
+        Returns tuple of prepared X, y training data set for model.
+
+        With use_cache only new or changed files are parsed, the
+        rest come from the columnar feature cache.
     '''
-    import os 
 
-    X, y = [], []
+    if use_cache:
+        X, y_codes = feature_cache.load_X_y(read_answers_file, folder_path)
+        return X, feature_cache.decode_labels(y_codes)
+
+    X, y = [np.empty((0, features.N_FEATURES))], [np.empty(0, dtype=np.int8)]
 
     # loop through all files in the folder
-    for filename in os.listdir(folder_path):
+    for filename in sorted(os.listdir(folder_path)):
         if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            
-            try:
-                data = read_json(file_path)
-
-                # read and append answer data
-                for answer in data:
-                    try:
-                        result = compute_weighted_correct(int(answer['result']), float(answer['time_taken']))
-                        difficulty = int(answer['difficulty'])
-                        time_taken_logged = np.log(float(answer['time_taken']) + 1) # normalize time with log
-
-                        # assign label based on actual performance, not prediction
-                        if result == gui.CORRECT and difficulty >= gui.MEDIUM:
-                            label = "high"
-                        elif result == gui.CORRECT:
-                            label = "medium"
-                        else:
-                            label = "low"
-
-                        X.append([result, difficulty, time_taken_logged])
-                        y.append(label)
-
-                    except (KeyError, ValueError, TypeError) as e:
-                        print(f"Skipping bad entry in {filename}: {e}")
-            
-            except Exception as e:
-                print(f"Error: {e}, Reading: {file_path}", sys.stderr)
-
-    return X, y
-
-def grapher(model : DecisionTreeClassifier):
+            X_file, y_file = read_answers_file(os.path.join(folder_path, filename))
+            X.append(X_file)
+            y.append(y_file)
+
+    # then every logged session
+    records = list(SessionLog(os.path.join(folder_path, os.path.basename(session_log.path))).scan())
+    if records:
+        X_log, y_log = feature_cache.log_rows(records)
+        X.append(X_log)
+        y.append(y_log)
+
+    return np.concatenate(X), feature_cache.decode_labels(np.concatenate(y))
+
+def grapher(model : "DecisionTreeClassifier"):
     '''Graphs the importance of features in decision tree.'''
     import matplotlib.pyplot as plt
 
@@ -124,26 +139,85 @@ def grapher(model : DecisionTreeClassifier):
     plt.show()
 
 
-# main
-def main():
+def parse_args(argv : list = None) -> argparse.Namespace:
+    '''Parses command line options, any unknown argument shows the graph'''
+
+    parser = argparse.ArgumentParser(description="Cognitive ability test")
+    parser.add_argument("--retrain", action="store_true",
+                        help="ignore the stored model and retrain from data/")
+    parser.add_argument("--graph", action="store_true",
+                        help="show the feature importance graph and exit")
+    parser.add_argument("--model-path", default=model_store.DEFAULT_MODEL_PATH,
+                        help="where the trained model is stored")
+    parser.add_argument("--questions", default="input/questions.json",
+                        help="questions file, .jsonl files are loaded lazily")
+    parser.add_argument("--predict-mode", default="tree", choices=PREDICT_MODES,
+                        help="inference path used between questions")
+    parser.add_argument("--prediction-cache", type=int, default=DEFAULT_CACHE_SIZE, metavar="N",
+                        help="LRU entries memoizing tree predictions, 0 turns the cache off")
+    parser.add_argument("--policy", metavar="PATH", default=None,
+                        help="route questions with a compiled policy (python policy.py compile) instead of the model")
+    parser.add_argument("--early-stop", action="store_true",
+                        help="end a test once its result can no longer change")
+    parser.add_argument("--stop-confidence", type=float, default=None, metavar="C",
+                        help="also end a test once the leading label is ahead at confidence C, implies --early-stop")
+    parser.add_argument("--min-answers", type=int, default=3,
+                        help="answers before --stop-confidence may end a test")
+    parser.add_argument("--fast-start", action="store_true",
+                        help="serve the last compiled model without loading sklearn or evaluating")
+    parser.add_argument("--stream", action="store_true",
+                        help="train out-of-core in chunks instead of loading all answers")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="answers per chunk with --stream")
+    parser.add_argument("--sample-size", type=int, default=None,
+                        help="reservoir sample size with --stream, default 4 chunks")
+    parser.add_argument("--stratified", action="store_true", help="sample every label separately")
+    parser.add_argument("--incremental", action="store_true",
+                        help="update a partial_fit model on every chunk instead of sampling")
+    parser.add_argument("--search", action="store_true",
+                        help="parallel hyperparameter search, stores the best model and exits")
+    parser.add_argument("--rescore", nargs="?", const="rescore_report.csv", metavar="REPORT",
+                        help="re-score every stored session with the current model and exit")
+    parser.add_argument("--serve", action="store_true",
+                        help="host tests over a local HTTP/JSON API instead of the GUI")
+    parser.add_argument("--host", default="127.0.0.1", help="server host")
+    parser.add_argument("--port", type=int, default=8080, help="server port")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="with --serve, pre-forked worker processes sharing the model and bank")
+    parser.add_argument("--batch-window-ms", type=float, default=None,
+                        help="with --serve, batch next-question predictions over this window (0 = same loop turn)")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="with --batch-window-ms, flush a batch early at this many predictions")
+    parser.add_argument("--log-level", default=background.DEFAULT_LOG_LEVEL,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper,
+                        help="default INFO, or $COGNITIVE_LOG_LEVEL")
+    parser.add_argument("--log-file", default=None, help="also write the log to this file")
+    parser.add_argument("--timings", metavar="PATH", default=None,
+                        help="write per stage latency histograms on exit, .csv or .json")
+    parser.add_argument("--no-timings", action="store_true", help="turn stage timing off")
+    parser.add_argument("--profile", metavar="PATH", default=None,
+                        help="run under cProfile and dump the stats to PATH")
+    parser.add_argument("--online", action="store_true",
+                        help="keep refitting the model from completed sessions in the background")
+    parser.add_argument("--online-interval", type=float, default=30.0,
+                        help="seconds between online refits at most")
+    parser.add_argument("--online-batch", type=int, default=1,
+                        help="completed sessions that trigger an online refit early")
+
+    args, unknown = parser.parse_known_args(argv)
+    args.graph = args.graph or len(unknown) > 0 # keep old 'any argument' behaviour
+    return args
+
+def train_model(X_train : list, y_train : list) -> "DecisionTreeClassifier":
+    '''Evaluates a fresh decision tree, logs its metrics and refits it on all data.'''
+    from sklearn.tree import DecisionTreeClassifier
 
-    # read questions from json file
-    low_questions, medium_questions, high_questions = get_questions("input/questions.json")
-
-    ''' Read and prepare previous answers from previous tests in 'data/'. 
-        This will be our training data to train the Decision Tree.
-    '''
-    X_train, y_train = get_answers_to_X_y()
-
-    # normalize control data and extend training set
-    dummy_X_logged = [[compute_weighted_correct(x[0], x[2]), x[1], np.log(x[2] + 1)] for x in dummy_X]
-    X_train.extend(dummy_X_logged)
-    y_train.extend(dummy_y)
-    
     model=DecisionTreeClassifier(class_weight="balanced") # initialize model
 
     # evaluate the model
     if len(X_train) >= 5:  # only evaluate if we have enough samples
+        from sklearn.model_selection import train_test_split, cross_val_score
+        from sklearn.metrics import accuracy_score, classification_report
+
         X_train_split, X_test, y_train_split, y_test = train_test_split(X_train, y_train, test_size=0.2, random_state=42)
         model.fit(X_train_split, y_train_split)
         y_pred = model.predict(X_test)
@@ -158,27 +232,289 @@ def main():
             log.write("\t\t\t\t\t   --- Classification Report ---\n")
             log.write(classification_report(y_test, y_pred))
 
-    # use any command line input to view graph of feature importance
-    if len(sys.argv) > 1:
-        grapher(model)
-        return
-    
     # refit the model with non split
     model.fit(X_train, y_train)
+    return model
+
+def model_fingerprint(**training) -> str:
+    '''
+        fingerprint of the training data, features and control data the
+        model depends on, plus any non default training options
+    '''
+    from sklearn.tree import DecisionTreeClassifier
+
+    return model_store.data_fingerprint(
+        "data",
+        features=FEATURES,
+        feature_version=features.FEATURE_VERSION,
+        dummy_X=dummy_X,
+        dummy_y=dummy_y,
+        params=DecisionTreeClassifier(class_weight="balanced").get_params(),
+        **training
+    )
+
+def get_training_data():
+    ''' Read and prepare previous answers from previous tests in 'data/'. 
+        This will be our training data to train the Decision Tree.
+    '''
+    X_train, y_train = get_answers_to_X_y()
+
+    # normalize control data and extend training set
+    dummy_X_logged, dummy_labels = get_control_data()
+    X_train = np.vstack([X_train, dummy_X_logged])
+    y_train = np.concatenate([y_train, dummy_labels])
+    return X_train, y_train
+
+def get_control_data():
+    '''control data as (feature matrix, labels)'''
+    dummy = np.asarray(dummy_X, dtype=np.float64)
+    return features.build_features(dummy[:, 0], dummy[:, 1], dummy[:, 2]), np.asarray(dummy_y)
+
+def get_model(retrain : bool = False, model_path : str = model_store.DEFAULT_MODEL_PATH,
+              stream : Optional[dict] = None) -> "DecisionTreeClassifier":
+    '''
+        Loads the stored model if the training data has not changed
+        since it was saved, otherwise retrains and stores a new one.
+        With stream options the archive is trained on out-of-core,
+        see streaming.train_streaming. model_store keeps a compiled
+        copy next to the stored model for get_fast_model.
+    '''
+
+    fingerprint = model_fingerprint(stream=stream) if stream else model_fingerprint()
+
+    model = None if retrain else model_store.load_model(fingerprint, model_path)
+    if model is None:
+        if stream:
+            model = train_model_streaming(**stream)
+        else:
+            X_train, y_train = get_training_data()
+            model = train_model(X_train, y_train)
+        model_store.save_model(model, fingerprint, model_path)
+
+    # models stored before the compiled copy followed every save
+    stored_hash = model_store.model_hash(model_path)
+    if hasattr(model, "tree_") and model_store.load_compiled(model_path, fingerprint, stored_hash) is None:
+        model_store.save_compiled(CompiledTree(model).arrays(), fingerprint, model_path, stored_hash)
+    return model
+
+def get_fast_model(model_path : str = model_store.DEFAULT_MODEL_PATH) -> Optional[CompiledTree]:
+    '''
+        The compiled copy of the last stored model, loaded without sklearn.
+        It is used even if data/ has changed since, that only logs a note.
+        None if no compiled model was stored yet.
+    '''
+
+    arrays = model_store.load_compiled(model_path)
+    if arrays is None:
+        return None
+    if str(arrays["data"]) != model_store.data_fingerprint():
+        logging.info("Fast start: data/ changed since the model was trained, run without --fast-start to retrain")
+    return CompiledTree.from_arrays(arrays)
+
+def train_model_streaming(chunk_size : int, sample_size : Optional[int] = None,
+                          stratified : bool = False, incremental : bool = False):
+    '''
+        Trains without holding the archive in memory. incremental uses a
+        partial_fit linear model over every chunk, otherwise the decision
+        tree is fit on a reservoir sample.
+    '''
+    import streaming
+    from sklearn.tree import DecisionTreeClassifier
+
+    if incremental:
+        from sklearn.linear_model import SGDClassifier
+        model = SGDClassifier(loss="log_loss", random_state=0)
+    else:
+        model = DecisionTreeClassifier(class_weight="balanced")
+
+    return streaming.train_streaming(model, read_answers_file, "data", chunk_size,
+                                     sample_size, stratified, extra=get_control_data())
+
+
+def start_online_updater(predictor, interval : float, min_sessions : int):
+    '''
+        Background updater that refits the model on the training data plus
+        each saved session and swaps it into predictor. Refits keep the
+        live model's parameters, e.g. the ones found by --search.
+    '''
+    from online import OnlineUpdater
+    from sklearn.base import clone
+
+    X_train, y_train = get_training_data()
+    return OnlineUpdater(predictor, X_train, y_train,
+                         model_factory=lambda: clone(predictor.model),
+                         interval=interval, min_sessions=min_sessions, accept=is_saved).start()
+
+def stopping_rule(args : argparse.Namespace):
+    '''engine.StoppingRule from the command line, None unless asked for'''
+
+    if not args.early_stop and args.stop_confidence is None:
+        return None
+    from engine import StoppingRule
+    return StoppingRule(args.stop_confidence, args.min_answers)
+
+def load_policy(path : str, model, online : bool = False):
+    '''
+        Loads a compiled policy and warns if it no longer routes like
+        model, e.g. after a retrain. Sessions use it as loaded.
+    '''
+    from policy import Policy, format_diff
+
+    policy = Policy.load(path)
+    changes = Policy.compile(model).diff(policy)
+    if changes:
+        logging.warning("Policy %s routes differently from the current model, recompile it:\n%s",
+                        path, format_diff(changes))
+    if online:
+        logging.warning("--online refits the model but not the policy, routing stays fixed")
+    return policy
+
+def is_saved(session) -> bool:
+    '''whether save_answers keeps a session: named, with answers and a determined ability'''
+    return len(session.answers) > 0 and session.determined and bool(session.username)
+
+def save_answers(session) -> None:
+    '''append answers and predictions to the session log if answers exists'''
+
+    if is_saved(session): # only save if cognitive ability is determined
+        session_log.append(session.answers, session.username.lower())
+
+
+# main
+def main():
+
+    args = parse_args()
+
+    # logs and completed sessions are written by background threads
+    log_listener = background.setup_logging(args.log_level, args.log_file)
+    session_writer = background.SessionWriter(save_answers)
+    instrumentation.TIMINGS.enabled = not args.no_timings
+    try:
+        with instrumentation.profile(args.profile):
+            run(args, session_writer, log_listener)
+    finally:
+        session_writer.stop()
+        logging.info(f"Session writer: {session_writer.lag()}")
+        if args.timings:
+            instrumentation.TIMINGS.export(args.timings)
+        log_listener.stop()
+
+def run(args : argparse.Namespace, session_writer : background.SessionWriter,
+        log_listener : background.LogListener) -> None:
+    '''runs the mode selected on the command line'''
+
+    # read questions from json file
+    question_bank = get_question_bank(args.questions)
+
+    # search for the best model across all cores
+    if args.search:
+        import model_search
+
+        X_train, y_train = get_training_data()
+        report = model_search.search(X_train, y_train) # python model_search.py --compare-serial times a serial run too
+        model_search.save_search(report, model_fingerprint(), args.model_path)
+        print(model_search.summary(report))
+        return
+
+    stream = None
+    if args.stream:
+        stream = {"chunk_size": args.chunk_size, "sample_size": args.sample_size,
+                  "stratified": args.stratified, "incremental": args.incremental}
+
+    # fast start only needs the compiled tree, anything that trains or inspects the model does not apply.
+    # Without a compiled tree it falls back to the normal load, which trains and evaluates if needed
+    fast_start = args.fast_start and not (args.retrain or args.graph or args.online or stream)
+    model = get_fast_model(args.model_path) if fast_start else None
+    if model is None:
+        model = get_model(args.retrain, args.model_path, stream)
+
+    # use command line input to view graph of feature importance
+    if args.graph:
+        grapher(model)
+        return
+
+    stopping = stopping_rule(args)
+
+    # batch score the whole archive
+    if args.rescore:
+        import rescore
+        from compiled_tree import Predictor
+
+        predictor = Predictor(model, args.predict_mode)
+        scores = rescore.rescore(predictor, read_answers_file)
+        rescore.write_report(scores, args.rescore)
+        print(rescore.summary(scores))
+        if stopping is not None:
+            replay = rescore.early_stop_replay(predictor, read_answers_file, stopping, len(question_bank))
+            print(rescore.early_stop_summary(replay))
+        return
+
+    # precompiled routing, checked against the model it is served next to
+    policy = load_policy(args.policy, model, args.online) if args.policy else None
+
+    # several processes, each worker saves its own finished sessions
+    if args.serve and args.workers > 1:
+        from sharding import ShardedServer
+        if args.online:
+            logging.warning("--online is ignored with --workers, the workers share one fixed model")
+
+        sharded = ShardedServer(question_bank, model, args.workers, args.host, args.port,
+                                args.predict_mode, on_finished=save_answers, log_level=args.log_level,
+                                batch_window_ms=args.batch_window_ms, batch_size=args.batch_size,
+                                cache_size=args.prediction_cache, policy=policy, stopping=stopping).start()
+        try:
+            sharded.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sharded.stop()
+        return
+
+    # one predictor shared by every session, swapped in place by online updates
+    from compiled_tree import Predictor
+    predictor = Predictor(model, args.predict_mode, cache_size=args.prediction_cache)
+    online = start_online_updater(predictor, args.online_interval, args.online_batch) if args.online else None
+
+    # host many sessions sharing one model
+    if args.serve:
+        import asyncio
+        from server import TestServer
+
+        batcher = None
+        if args.batch_window_ms is not None:
+            from batching import BatchScheduler
+            batcher = BatchScheduler(predictor, args.batch_window_ms, args.batch_size)
+
+        test_server = TestServer(question_bank,
+                                 predictor,
+                                 on_finished=session_writer.submit,
+                                 online=online,
+                                 lag={"sessions": session_writer.lag, "logs": log_listener.lag},
+                                 batcher=batcher,
+                                 policy=policy,
+                                 stopping=stopping)
+        try:
+            asyncio.run(test_server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        if online is not None:
+            online.stop()
+        return
 
     # initialize GUI and start test
-    project_gui = gui.GUI(low_questions,
-                          medium_questions, 
-                          high_questions, 
-                          model)
+    import GUI as gui
+    project_gui = gui.GUI(question_bank,
+                          predictor,
+                          args.predict_mode,
+                          policy,
+                          stopping)
     project_gui.start_test()
-
-    # save answers and predictions to JSON file if answers exists
-    if not project_gui.answers_list is None and len(project_gui.answers_list) > 0:
-        if project_gui.determined: # only save if cognitive ability is determined
-            file_name = 'data/' + project_gui.username.lower() + '_answers.json'
-            with open(file_name, 'w') as out_jf:
-                json.dump(project_gui.answers_list, out_jf, indent=4)
+    if predictor.cache is not None:
+        logging.info("Prediction cache: %s", predictor.cache.stats())
+    session_writer.submit(project_gui)
+    if online is not None:
+        online.submit(project_gui)
+        online.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+# model_search.py
+# Author: Andrew Kelton
+
+'''
+Parallel hyperparameter search for the cognitive ability model.
+  * Searches decision tree depth, min samples per leaf and criterion,
+    and optionally small random forest / extra trees ensembles.
+  * Cross validation folds are split once and, together with the
+    feature matrix, handed to each worker process once through the
+    pool initializer instead of being rebuilt per candidate.
+  * Reports the wall clock speedup over a serial run, persists the best
+    model through model_store and writes its metrics next to it.
+'''
+
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.model_selection import StratifiedKFold, KFold
+
+import model_store
+
+DEFAULT_METRICS_PATH="models/search_metrics.json"
+CV_FOLDS=5
+
+TREE_GRID={
+    "max_depth": [None, 2, 3, 4, 6, 8],
+    "min_samples_leaf": [1, 2, 4, 8],
+    "criterion": ["gini", "entropy", "log_loss"]
+}
+ENSEMBLE_GRID={
+    "n_estimators": [10, 25],
+    "max_depth": [None, 4],
+    "min_samples_leaf": [1, 4]
+}
+
+# per worker copies of the data, set once by _init_worker
+_X = _y = _splits = None
+
+
+def candidates(ensembles : bool = False) -> List[Tuple[type, Dict[str, Any]]]:
+    '''(estimator class, params) pairs to evaluate, simplest trees first'''
+
+    def grid(values : Dict[str, list]) -> List[Dict[str, Any]]:
+        keys = list(values)
+        return [dict(zip(keys, combo)) for combo in itertools.product(*values.values())]
+
+    found = [(DecisionTreeClassifier, params) for params in grid(TREE_GRID)]
+    if ensembles:
+        for estimator in (RandomForestClassifier, ExtraTreesClassifier):
+            found += [(estimator, dict(params, random_state=0)) for params in grid(ENSEMBLE_GRID)]
+    return found
+
+def fold_splits(y : np.ndarray, n_splits : int = CV_FOLDS) -> List[Tuple[np.ndarray, np.ndarray]]:
+    '''
+        Train/test indexes of every fold, computed once. Stratified when
+        every label has enough samples, plain shuffled folds otherwise.
+    '''
+
+    _, counts = np.unique(y, return_counts=True)
+    splitter = StratifiedKFold(n_splits, shuffle=True, random_state=42) if counts.min() >= n_splits \
+        else KFold(n_splits, shuffle=True, random_state=42)
+    return list(splitter.split(np.zeros(len(y)), y))
+
+def _init_worker(X : np.ndarray, y : np.ndarray, splits : list) -> None:
+    '''stores the shared data in a worker process'''
+    global _X, _y, _splits
+    _X, _y, _splits = X, y, splits
+
+def _evaluate(candidate : Tuple[type, Dict[str, Any]]) -> Dict[str, Any]:
+    '''cross validated accuracy of one candidate on the worker's cached folds'''
+
+    estimator, params = candidate
+    scores = []
+    start = time.perf_counter()
+    for train_idx, test_idx in _splits:
+        model = estimator(class_weight="balanced", **params)
+        model.fit(_X[train_idx], _y[train_idx])
+        scores.append(float(np.mean(model.predict(_X[test_idx]) == _y[test_idx])))
+
+    return {
+        "estimator": estimator.__name__,
+        "params": params,
+        "scores": scores,
+        "mean": float(np.mean(scores)),
+        "std": float(np.std(scores)),
+        "fit_s": time.perf_counter() - start
+    }
+
+def evaluate_all(X : np.ndarray, y : np.ndarray, splits : list, grid : list,
+                 workers : Optional[int] = None) -> Tuple[List[Dict[str, Any]], float]:
+    '''evaluates every candidate, in a process pool when workers != 1, returns (results, seconds)'''
+
+    start = time.perf_counter()
+    if workers == 1:
+        _init_worker(X, y, splits)
+        results = [_evaluate(candidate) for candidate in grid]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, y, splits)) as pool:
+            results = list(pool.map(_evaluate, grid, chunksize=max(1, len(grid) // (4 * (workers or os.cpu_count() or 1)))))
+    return results, time.perf_counter() - start
+
+def search(X : np.ndarray, y : np.ndarray, ensembles : bool = False, workers : Optional[int] = None,
+           compare_serial : bool = False) -> Dict[str, Any]:
+    '''
+        Runs the search and returns the best refit model with a report of
+        every candidate, the parallel wall clock and, if requested, the
+        serial wall clock for the same grid.
+    '''
+
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.asarray(y)
+    splits = fold_splits(y)
+    grid = candidates(ensembles)
+
+    results, parallel_s = evaluate_all(X, y, splits, grid, workers)
+    serial_s = evaluate_all(X, y, splits, grid, workers=1)[1] if compare_serial else None
+
+    # first best wins, candidates are ordered simplest first
+    best_i = max(range(len(results)), key=lambda i: (results[i]["mean"], -i))
+    estimator, params = grid[best_i]
+    best_model = estimator(class_weight="balanced", **params).fit(X, y)
+
+    return {
+        "model": best_model,
+        "best": results[best_i],
+        "results": results,
+        "candidates": len(grid),
+        "workers": workers or os.cpu_count(),
+        "parallel_s": parallel_s,
+        "serial_s": serial_s,
+        "speedup": serial_s / parallel_s if serial_s else None
+    }
+
+def save_search(report : Dict[str, Any], fingerprint : str,
+                model_path : str = model_store.DEFAULT_MODEL_PATH,
+                metrics_path : str = DEFAULT_METRICS_PATH) -> None:
+    '''persists the best model and writes the search metrics as JSON'''
+
+    metrics = {key: value for key, value in report.items() if key != "model"}
+    model_store.save_model(report["model"], fingerprint, model_path, metrics=metrics["best"])
+
+    os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+    with open(metrics_path, "w") as f:
+        json.dump(metrics, f, indent=4, default=repr)
+
+def summary(report : Dict[str, Any]) -> str:
+    '''short text summary of a search'''
+
+    best = report["best"]
+    text = (f"Searched {report['candidates']} candidates on {report['workers']} workers "
+            f"in {report['parallel_s']:.2f}s\n"
+            f"Best: {best['estimator']} {best['params']} mean CV accuracy {best['mean']:.4f} (+/- {best['std']:.4f})")
+    if report["serial_s"] is not None:
+        text += f"\nSerial: {report['serial_s']:.2f}s, speedup {report['speedup']:.2f}x"
+    return text
+
+
+if __name__ == '__main__':
+    import argparse
+    import main
+
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter search for the ability model")
+    parser.add_argument("--ensembles", action="store_true", help="also try small tree ensembles")
+    parser.add_argument("--workers", type=int, default=None, help="processes, defaults to all cores")
+    parser.add_argument("--compare-serial", action="store_true", help="also time a serial run")
+    parser.add_argument("--model-path", default=model_store.DEFAULT_MODEL_PATH)
+    args = parser.parse_args()
+
+    X_train, y_train = main.get_training_data()
+    report = search(X_train, y_train, args.ensembles, args.workers, args.compare_serial)
+    save_search(report, main.model_fingerprint(), args.model_path)
+    print(summary(report))
@@ -0,0 +1,159 @@
+# model_store.py
+# Author: Andrew Kelton
+
+'''
+Persisted model artifact for the cognitive ability decision tree.
+  * Saves the fitted model next to a fingerprint of the data it was
+    trained on (answer files, feature schema, model parameters).
+  * Loads the saved model on startup and only asks for a retrain
+    when the fingerprint no longer matches.
+  * A compiled copy of the tree is saved as plain numpy arrays next to
+    it, so a fast start can serve predictions without importing sklearn.
+    Every save_model refreshes it and it records a hash of the pickled
+    model, so it can never outlive the model it was compiled from.
+'''
+
+from typing import Any, Dict, Optional
+import hashlib
+import json
+import os
+import pickle
+
+STORE_VERSION=1
+DEFAULT_MODEL_PATH="models/model.pkl"
+COMPILED_SUFFIX=".compiled.npz"
+
+
+def data_fingerprint(folder_path : str = "data", **schema) -> str:
+    '''
+        Hash of everything the trained model depends on: the name, size
+        and mtime of every answer file and session log in folder_path plus any extra
+        schema values passed in (features, control data, parameters).
+    '''
+
+    files = []
+    if os.path.isdir(folder_path):
+        for filename in sorted(os.listdir(folder_path)):
+            if filename.endswith((".json", ".log")):
+                stat = os.stat(os.path.join(folder_path, filename))
+                files.append([filename, stat.st_size, stat.st_mtime_ns])
+
+    payload = {"version": STORE_VERSION, "files": files, "schema": schema}
+    encoded = json.dumps(payload, sort_keys=True, default=repr).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def save_model(model, fingerprint : str, path : str = DEFAULT_MODEL_PATH, metrics : Optional[Dict[str, Any]] = None) -> None:
+    '''Writes the model and its fingerprint to path atomically'''
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    artifact = {
+        "version": STORE_VERSION,
+        "fingerprint": fingerprint,
+        "model": model,
+        "metrics": metrics or {}
+    }
+
+    # write to a temp file first so a crash never leaves a half written model
+    encoded = pickle.dumps(artifact, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded)
+    os.replace(tmp_path, path)
+
+    # retrains and searches save under the same fingerprint, the compiled copy follows every save
+    if hasattr(model, "tree_"):
+        from compiled_tree import CompiledTree
+        save_compiled(CompiledTree(model).arrays(), fingerprint, path, hashlib.sha256(encoded).hexdigest())
+    elif os.path.exists(compiled_path(path)):
+        os.remove(compiled_path(path)) # not a tree, a fast start must not serve the previous one
+
+
+def model_hash(path : str = DEFAULT_MODEL_PATH) -> Optional[str]:
+    '''sha256 of the stored model file, None if there is none'''
+
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def load_artifact(path : str = DEFAULT_MODEL_PATH) -> Optional[Dict[str, Any]]:
+    '''Returns the stored artifact dict, or None if missing or unreadable'''
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            artifact = pickle.load(f)
+    except Exception as e:
+        print(f"Error: {e}, Reading: {path}")
+        return None
+
+    if not isinstance(artifact, dict) or artifact.get("version") != STORE_VERSION:
+        return None
+    return artifact
+
+
+def load_model(fingerprint : str, path : str = DEFAULT_MODEL_PATH):
+    '''Returns the stored model if it was trained on fingerprint, else None'''
+
+    artifact = load_artifact(path)
+    if artifact is None or artifact["fingerprint"] != fingerprint:
+        return None
+    return artifact["model"]
+
+
+def compiled_path(path : str = DEFAULT_MODEL_PATH) -> str:
+    '''where the compiled copy of the model at path is stored'''
+    return os.path.splitext(path)[0] + COMPILED_SUFFIX
+
+
+def save_compiled(arrays : Dict[str, Any], fingerprint : str, path : str = DEFAULT_MODEL_PATH,
+                  stored_hash : Optional[str] = None) -> None:
+    '''
+        Writes compiled tree arrays next to the model at path, with the
+        model's fingerprint, the hash of the stored model file and a
+        fingerprint of the data folder alone.
+    '''
+
+    import numpy as np
+
+    target = compiled_path(path)
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    with open(target + ".tmp", "wb") as f:
+        np.savez(f, version=STORE_VERSION, fingerprint=fingerprint, data=data_fingerprint(),
+                 model=stored_hash or model_hash(path) or "", **arrays)
+    os.replace(target + ".tmp", target)
+
+
+def load_compiled(path : str = DEFAULT_MODEL_PATH, fingerprint : Optional[str] = None,
+                  stored_hash : Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''
+        Compiled tree arrays stored next to the model at path, or None if
+        missing, unreadable or not built for fingerprint and stored_hash
+        (see model_hash). Checking a fingerprint needs sklearn, so a fast
+        start passes None and may compare the stored "data" fingerprint
+        with data_fingerprint().
+    '''
+
+    import numpy as np
+
+    try:
+        with np.load(compiled_path(path), allow_pickle=False) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+    except (OSError, ValueError) as e:
+        if os.path.exists(compiled_path(path)):
+            print(f"Error: {e}, Reading: {compiled_path(path)}")
+        return None
+
+    if int(arrays.pop("version")) != STORE_VERSION:
+        return None
+    if fingerprint is not None and str(arrays["fingerprint"]) != fingerprint:
+        return None
+    if stored_hash is not None and str(arrays.get("model", "")) != stored_hash:
+        return None
+    return arrays
@@ -0,0 +1,144 @@
+# online.py
+# Author: Andrew Kelton
+
+'''
+Online model updates from completed sessions.
+  * Finished sessions are queued with OnlineUpdater.submit, which never
+    blocks the caller. Only sessions accept() keeps are learned from, the
+    same ones that are persisted, so the live model matches what a
+    restart would train.
+  * A background thread refits the model on the training data plus all
+    new answers (or calls partial_fit on a copy when the model supports
+    it) and swaps it into the shared Predictor in one assignment, so
+    active sessions never wait on training or see a half updated model.
+  * stats() reports how long new answers took to reach the live model.
+'''
+
+from typing import Any, Callable, Dict, List, Optional
+import copy
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+from features import label_codes
+from instrumentation import Histogram
+
+
+class OnlineUpdater:
+
+    def __init__(self,
+                 predictor,
+                 X_base : np.ndarray,
+                 y_base : np.ndarray,
+                 model_factory : Callable[[], Any],
+                 interval : float = 30.0,
+                 min_sessions : int = 1,
+                 accept : Optional[Callable[[Any], bool]] = None
+                ):
+
+        self.predictor = predictor         # shared with every session
+        self.model_factory = model_factory # fresh unfitted model for each refit
+        self.interval = interval           # seconds between refits at most
+        self.min_sessions = min_sessions   # refit early once this many are queued
+        self.accept = accept               # sessions worth learning from, default all with answers
+
+        self.X = np.asarray(X_base, dtype=np.float64)
+        self.y = np.asarray(y_base)
+        self.queue = queue.Queue()
+
+        # measurements
+        self.updates = 0
+        self.sessions_applied = 0
+        self.last_refit_s = 0.0
+        self.reflect = Histogram() # queued -> live of every applied session, fixed size
+        self.lock = threading.Lock()
+
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="online-updater", daemon=True)
+
+    def start(self) -> "OnlineUpdater":
+        self.__thread.start()
+        return self
+
+    def stop(self, timeout : Optional[float] = None) -> None:
+        '''stops the thread after applying whatever is still queued'''
+        self.__stop.set()
+        self.__thread.join(timeout)
+
+    def submit(self, session) -> None:
+        '''queues a finished session's feature rows, never blocks'''
+
+        if len(session.answers) and (self.accept is None or self.accept(session)):
+            self.queue.put((time.perf_counter(), session.answers.features()))
+
+    def __run(self) -> None:
+        '''collects sessions and refits off the request path'''
+
+        pending = []
+        deadline = time.perf_counter() + self.interval
+        while not self.__stop.is_set() or not self.queue.empty():
+            try:
+                pending.append(self.queue.get(timeout=max(0.0, min(deadline - time.perf_counter(), 0.5))))
+            except queue.Empty:
+                pass
+
+            now = time.perf_counter()
+            due = now >= deadline or len(pending) >= self.min_sessions or self.__stop.is_set()
+            if pending and due:
+                try:
+                    self.__apply(pending)
+                except Exception as e:
+                    logging.warning(f"Online update failed: {e}")
+                pending = []
+            if now >= deadline:
+                deadline = now + self.interval
+
+    def __apply(self, pending : List[tuple]) -> None:
+        '''refits with the pending sessions and swaps the model in'''
+
+        start = time.perf_counter()
+
+        X_new = np.vstack([X for _, X in pending])
+        y_new = np.asarray(COGNITIVE_ABILITIES_STRING)[label_codes(X_new)]
+
+        current = self.predictor.model
+        if hasattr(current, "partial_fit"):
+            model = copy.deepcopy(current) # the live model keeps serving until the swap
+            model.partial_fit(X_new, y_new)
+        else:
+            self.X = np.vstack([self.X, X_new])
+            self.y = np.concatenate([self.y, y_new])
+            model = self.model_factory().fit(self.X, self.y)
+
+        self.predictor.swap(model)
+        live = time.perf_counter()
+
+        with self.lock:
+            self.updates += 1
+            self.sessions_applied += len(pending)
+            self.last_refit_s = live - start
+            for queued, _ in pending:
+                self.reflect.record(int((live - queued) * 1e9))
+
+        logging.info(f"Online update {self.updates}: {len(pending)} sessions, {len(X_new)} answers, "
+                     f"refit in {self.last_refit_s:.3f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        '''update counts and how quickly new data reaches the live model'''
+
+        with self.lock:
+            reflect = self.reflect
+            return {
+                "updates": self.updates,
+                "sessions_applied": self.sessions_applied,
+                "pending": self.queue.qsize(),
+                "training_rows": len(self.y),
+                "last_refit_s": self.last_refit_s,
+                "reflect_mean_s": reflect.total_ns / reflect.count / 1e9 if reflect.count else 0.0,
+                "reflect_p95_s": reflect.percentile(95) / 1e9,
+                "reflect_max_s": reflect.max_ns / 1e9
+            }
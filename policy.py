@@ -0,0 +1,312 @@
+# policy.py
+# Author: Andrew Kelton
+
+'''
+Precompiled adaptive test policy.
+  * The next difficulty only depends on the previous answer: correct or
+    not, its difficulty and its time. Correctness weighting only looks
+    at the 6s/10s speed edges and the tree only compares the logged time
+    with its thresholds, so the whole routing is a table over
+    (correct?, difficulty, time bucket) with bucket edges in seconds.
+  * compile() enumerates that table from a fitted model once, sessions
+    then route with one bisect and one index and never touch features
+    or the model (TestSession(policy=...), main --policy).
+  * Policies are JSON, readable and diffable. validate() replays the
+    stored sessions (data/sessions.log and any data/*_answers.json)
+    through the policy and the model and reports any answer they route
+    differently. Replaying no answers at all fails validation.
+  * Running this file compiles, validates or diffs policies.
+'''
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+import json
+import os
+import time
+
+import numpy as np
+
+from constants import INCORRECT, CORRECT, LOW, MEDIUM, HIGH, COGNITIVE_ABILITIES_STRING
+from features import FAST_TIME, SLOW_TIME, FEATURE_VERSION, build_features, answers_to_columns
+from compiled_tree import CompiledTree, time_thresholds
+from session_log import SessionLog, DEFAULT_LOG_PATH
+
+POLICY_VERSION=1
+DEFAULT_POLICY_PATH="models/policy.json"
+ANSWERS=("incorrect", "correct")  # table rows, index is correct?
+DIFFICULTIES=(LOW, MEDIUM, HIGH)
+
+
+def seconds_edge(threshold : float) -> float:
+    '''
+        Largest time t in seconds with log1p(t) <= threshold, so that
+        t <= edge gives the same side of the split as the logged time.
+    '''
+
+    edge = np.expm1(threshold)
+    while np.log1p(edge) > threshold:
+        edge = np.nextafter(edge, -np.inf)
+    while np.log1p(np.nextafter(edge, np.inf)) <= threshold:
+        edge = np.nextafter(edge, np.inf)
+    return float(edge)
+
+
+class Policy:
+    '''
+        Routing table: table[correct?][difficulty][bucket] is the label
+        the model predicts for an answer in that cell. Bucket b holds
+        edges[b - 1] < time_taken <= edges[b], the last one is unbounded.
+    '''
+
+    def __init__(self, edges : Sequence[float], table : List[List[List[str]]], meta : Optional[Dict[str, Any]] = None):
+
+        self.edges = [float(e) for e in edges]
+        self.table = table
+        self.meta = meta or {}
+
+        # numpy copies for route_many
+        self.edges_array = np.asarray(self.edges, dtype=np.float64)
+        self.table_array = np.asarray(table)
+
+    @classmethod
+    def compile(cls, model, **meta) -> "Policy":
+        '''
+            Enumerates the routing of a fitted decision tree (or a
+            CompiledTree). Cells are labelled with the model's own
+            predict, adjacent time buckets that route alike are merged.
+        '''
+
+        compiled = model if isinstance(model, CompiledTree) else CompiledTree(model)
+        tree_edges = [seconds_edge(t) for t in
+                      time_thresholds(compiled.feature_array, compiled.left_array, compiled.threshold_array)]
+
+        # weighted correctness changes at t < 6s and t < 10s
+        speed_edges = [float(np.nextafter(FAST_TIME, -np.inf)), float(np.nextafter(SLOW_TIME, -np.inf))]
+        edges = sorted(set(tree_edges + speed_edges))
+
+        # one representative time per bucket, its upper edge or just above the last
+        times = edges + [float(np.nextafter(edges[-1], np.inf))]
+        cells = [(correct, difficulty, t) for correct in (0, 1) for difficulty in DIFFICULTIES for t in times]
+        result = np.array([CORRECT if c else INCORRECT for c, _, _ in cells])
+        X = build_features(result, np.array([d for _, d, _ in cells]), np.array([t for _, _, t in cells]))
+
+        labels = model.predict(X) # the model itself, not a copy of its logic
+        table = np.asarray(labels).astype(str).reshape(len(ANSWERS), len(DIFFICULTIES), len(times))
+
+        # drop edges whose two sides route the same in every cell
+        keep = [b for b in range(len(edges)) if not np.array_equal(table[:, :, b], table[:, :, b + 1])]
+        table = table[:, :, keep + [len(edges)]]
+        edges = [edges[b] for b in keep]
+
+        meta = dict(meta, feature_version=FEATURE_VERSION, compiled_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        return cls(edges, table.tolist(), meta)
+
+    # ---- hot path ----
+
+    def route(self, result : int, difficulty : int, time_taken : float) -> str:
+        '''label of the next question's pool after one answer'''
+
+        # NaN is slow and right of every split, like the compiled tree
+        bucket = bisect_left(self.edges, time_taken) if time_taken == time_taken else len(self.edges)
+        return self.table[result != INCORRECT][difficulty][bucket]
+
+    def route_many(self, result, difficulty, time_taken) -> np.ndarray:
+        '''labels for arrays of answers'''
+
+        difficulty = np.asarray(difficulty)
+        if not np.isin(difficulty, DIFFICULTIES).all():
+            raise ValueError(f"difficulty outside {DIFFICULTIES}")
+        buckets = np.searchsorted(self.edges_array, np.asarray(time_taken, dtype=np.float64), side="left")
+        return self.table_array[(np.asarray(result) != INCORRECT).astype(np.intp), difficulty, buckets]
+
+    # ---- inspection ----
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": POLICY_VERSION,
+            "meta": self.meta,
+            "edges_s": self.edges,
+            "routes": {
+                answer: {COGNITIVE_ABILITIES_STRING[d]: self.table[c][d] for d in DIFFICULTIES}
+                for c, answer in enumerate(ANSWERS)
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data : Dict[str, Any]) -> "Policy":
+
+        if data.get("version") != POLICY_VERSION:
+            raise ValueError(f"Unsupported policy version {data.get('version')}")
+        if data.get("meta", {}).get("feature_version") != FEATURE_VERSION:
+            raise ValueError("Policy was compiled for another feature version, recompile it")
+
+        routes = data["routes"]
+        table = [[list(routes[answer][COGNITIVE_ABILITIES_STRING[d]]) for d in DIFFICULTIES] for answer in ANSWERS]
+        return cls(data["edges_s"], table, data.get("meta"))
+
+    def save(self, path : str = DEFAULT_POLICY_PATH) -> None:
+        '''writes the policy as JSON atomically'''
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path : str = DEFAULT_POLICY_PATH) -> "Policy":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def intervals(self) -> List[Tuple[float, float]]:
+        '''(from, to] in seconds of every bucket'''
+        bounds = [-np.inf] + self.edges + [np.inf]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def describe(self) -> str:
+        '''the routing as text, one line per answer, difficulty and time range'''
+
+        lines = []
+        for c, answer in enumerate(ANSWERS):
+            for d in DIFFICULTIES:
+                for (low, high), label in zip(self.intervals(), self.table[c][d]):
+                    lines.append(f"{answer:>9} {COGNITIVE_ABILITIES_STRING[d]:>6} "
+                                 f"{_format_range(low, high):>18} -> {label}")
+        return "\n".join(lines)
+
+    def diff(self, other : "Policy") -> List[Dict[str, Any]]:
+        '''time ranges where other routes differently from this policy'''
+
+        edges = sorted(set(self.edges) | set(other.edges))
+        bounds = [-np.inf] + edges + [np.inf]
+        times = edges + [float(np.nextafter(edges[-1], np.inf))] if edges else [0.0]
+
+        changes = []
+        for c, answer in enumerate(ANSWERS):
+            for d in DIFFICULTIES:
+                for b, t in enumerate(times):
+                    old = self.route(CORRECT if c else INCORRECT, d, t)
+                    new = other.route(CORRECT if c else INCORRECT, d, t)
+                    if old == new:
+                        continue
+                    last = changes[-1] if changes else None
+                    if last and last["answer"] == answer and last["difficulty"] == COGNITIVE_ABILITIES_STRING[d] \
+                            and last["to_s"] == bounds[b] and (last["old"], last["new"]) == (old, new):
+                        last["to_s"] = bounds[b + 1] # extends the previous range
+                    else:
+                        changes.append({"answer": answer, "difficulty": COGNITIVE_ABILITIES_STRING[d],
+                                        "from_s": bounds[b], "to_s": bounds[b + 1], "old": old, "new": new})
+        return changes
+
+
+def _format_range(low : float, high : float) -> str:
+    if low == -np.inf:
+        return f"<= {high:.3f}s"
+    if high == np.inf:
+        return f"> {low:.3f}s"
+    return f"{low:.3f}-{high:.3f}s"
+
+def format_diff(changes : List[Dict[str, Any]]) -> str:
+    '''diff() as text'''
+
+    if not changes:
+        return "Routing identical"
+    return "\n".join(f"{c['answer']:>9} {c['difficulty']:>6} {_format_range(c['from_s'], c['to_s']):>18}: "
+                     f"{c['old']} -> {c['new']}" for c in changes)
+
+
+def stored_sessions(folder_path : str = "data") -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    '''(name, answers list) of every answer file left in folder_path, then of its session log'''
+
+    for filename in sorted(os.listdir(folder_path)) if os.path.isdir(folder_path) else []:
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(folder_path, filename)) as f:
+                yield filename, json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}, Reading: {filename}")
+
+    for record in SessionLog(os.path.join(folder_path, os.path.basename(DEFAULT_LOG_PATH))).scan():
+        yield f"{record.username or 'session'} {record.session_id}", record.answers_list()
+
+
+def validate(policy : Policy, predictor, folder_path : str = "data") -> Dict[str, Any]:
+    '''
+        Replays every stored session in folder_path answer by answer and
+        compares the policy's routing with predictor.predict on the same
+        answers. Also reports how often the recorded predicted_difficulty
+        (made by whatever model was live back then) agrees. A policy is
+        only "identical" if at least one answer was replayed.
+    '''
+
+    report = {"sessions": 0, "answers": 0, "mismatches": [], "recorded": 0, "recorded_agree": 0}
+    for name, answers in stored_sessions(folder_path):
+        result, difficulty, time_taken = answers_to_columns(answers, name)
+        if not len(result):
+            continue
+
+        routed = policy.route_many(result, difficulty, time_taken)
+        single = [policy.route(r, d, t) for r, d, t in zip(result.tolist(), difficulty.tolist(), time_taken.tolist())]
+        expected = np.asarray(predictor.predict(build_features(result, difficulty, time_taken))).astype(str)
+
+        for i in np.flatnonzero((routed != expected) | (np.asarray(single) != expected)).tolist():
+            report["mismatches"].append({"session": name, "answer": i, "policy": single[i],
+                                         "model": str(expected[i]), "time_taken": float(time_taken[i])})
+
+        # the label recorded with answer i routed answer i + 1
+        recorded = [a.get("predicted_difficulty") for a in answers[1:len(result)]]
+        pairs = [(r, p) for r, p in zip(recorded, single[:-1]) if r is not None]
+        report["recorded"] += len(pairs)
+        report["recorded_agree"] += sum(r == p for r, p in pairs)
+
+        report["sessions"] += 1
+        report["answers"] += len(result)
+
+    # nothing replayed proves nothing
+    report["identical"] = report["answers"] > 0 and not report["mismatches"]
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    import main
+
+    parser = argparse.ArgumentParser(description="Compile, validate and diff adaptive test policies")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compile_cmd = commands.add_parser("compile", help="compile the current model, validate it and save it")
+    compile_cmd.add_argument("--output", default=DEFAULT_POLICY_PATH)
+    validate_cmd = commands.add_parser("validate", help="replay data/ through a policy and the current model")
+    validate_cmd.add_argument("policy", nargs="?", default=DEFAULT_POLICY_PATH)
+    diff_cmd = commands.add_parser("diff", help="routing changes between two policies")
+    diff_cmd.add_argument("old")
+    diff_cmd.add_argument("new")
+    show_cmd = commands.add_parser("show", help="print a policy's routing")
+    show_cmd.add_argument("policy", nargs="?", default=DEFAULT_POLICY_PATH)
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        print(format_diff(Policy.load(args.old).diff(Policy.load(args.new))))
+    elif args.command == "show":
+        print(Policy.load(args.policy).describe())
+    else:
+        model = main.get_model()
+        if args.command == "compile":
+            policy = Policy.compile(model, fingerprint=main.model_fingerprint())
+            if os.path.exists(args.output):
+                print(format_diff(Policy.load(args.output).diff(policy)))
+        else:
+            policy = Policy.load(args.policy)
+
+        report = validate(policy, model)
+        outcome = ("identical routing" if report["identical"] else
+                   f"{len(report['mismatches'])} mismatches" if report["answers"] else "nothing to validate against")
+        print(f"Replayed {report['sessions']} sessions, {report['answers']} answers: {outcome}; "
+              f"recorded predictions agree on {report['recorded_agree']}/{report['recorded']}")
+        for mismatch in report["mismatches"][:20]:
+            print(mismatch)
+
+        if args.command == "compile":
+            if not report["identical"]:
+                raise SystemExit("Policy was not validated against the model, not saved")
+            policy.save(args.output)
+            print(f"Saved {len(policy.edges) + 1} time buckets to {args.output}")
@@ -0,0 +1,281 @@
+# question_bank.py
+# Author: Andrew Kelton
+
+'''
+Immutable, preloaded question bank shared by every test session.
+  * QuestionBank keeps an id -> question table and one read only array
+    of question ids per difficulty. It is never modified after loading.
+  * LazyQuestionBank serves very large pools from a JSON Lines file (or
+    a shared memory buffer). It keeps only a compact offset index in
+    memory and materializes a question when it is actually served.
+  * QuestionDeck is the per session state: a cursor and the positions
+    swapped so far for each difficulty, so dealing and drawing are O(1)
+    and a session only stores the questions it has drawn.
+'''
+
+from typing import Any, Dict, List, Mapping, Optional
+from functools import lru_cache
+from types import MappingProxyType
+import json
+import mmap
+import os
+import random
+
+import numpy as np
+
+from constants import ID, DF, COGNITIVE_ABILITIES_STRING, DIFF_MAP, LOW, MEDIUM, HIGH
+
+DIFFICULTIES=(LOW, MEDIUM, HIGH)
+
+
+class QuestionBank:
+
+    def __init__(self, questions : List[Dict[str, Any]]):
+
+        # id -> question, difficulties already converted to ints
+        self.by_id : Mapping[int, Mapping[str, Any]] = MappingProxyType({
+            q[ID]: MappingProxyType(dict(q)) for q in questions
+        })
+
+        # per difficulty ids, in file order
+        pools = []
+        for difficulty in DIFFICULTIES:
+            ids = np.array([q[ID] for q in questions if q[DF] == difficulty], dtype=np.int32)
+            ids.flags.writeable = False
+            pools.append(ids)
+        self.pools = tuple(pools)
+        self.pool_ids = tuple(tuple(ids.tolist()) for ids in pools) # plain ints for the draw hot path
+
+    @classmethod
+    def from_json(cls, file_name : str) -> "QuestionBank":
+        '''
+            Reads a questions file of the form {"low": [...], "medium": [...],
+            "high": [...]} and converts difficulties to ints.
+        '''
+
+        with open(file_name, "r") as jf:
+            data = json.load(jf)
+
+        questions = []
+        for ability in COGNITIVE_ABILITIES_STRING:
+            for q in data.get(ability, []):
+                questions.append(dict(q, **{DF: DIFF_MAP[q[DF]]}))
+        return cls(questions)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def get(self, question_id : int) -> Mapping[str, Any]:
+        '''question by id'''
+        return self.by_id[question_id]
+
+    def pool_size(self, difficulty : int) -> int:
+        return len(self.pools[difficulty])
+
+    def pool_questions(self, difficulty : int) -> List[Dict[str, Any]]:
+        '''mutable copies of one difficulty's questions, in file order'''
+        return [dict(self.get(int(i))) for i in self.pools[difficulty]]
+
+    def deck(self, rng : Optional[random.Random] = None) -> "QuestionDeck":
+        '''new shuffled per session view of the bank'''
+        return QuestionDeck(self, rng)
+
+
+class LazyQuestionBank(QuestionBank):
+    '''
+        QuestionBank over a JSON Lines file with one question per line.
+        The (id, difficulty, offset, length) index is built in one streaming
+        pass and cached next to the file, so later startups only load the
+        index. Served questions are parsed from the memory mapped file and
+        kept in a small LRU cache.
+    '''
+
+    INDEX_DTYPE=np.dtype([("id", "<i8"), ("difficulty", "i1"), ("offset", "<i8"), ("length", "<i4")])
+
+    def __init__(self, file_name : str, cache_size : int = 1024):
+
+        self.file_name = file_name
+        index = self.__load_index()
+
+        self.__file = open(file_name, "rb")
+        data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ) if len(index) else b""
+        self.__setup(index, data, cache_size)
+
+    @classmethod
+    def from_buffer(cls, index : np.ndarray, data, cache_size : int = 1024) -> "LazyQuestionBank":
+        '''
+            Bank over JSON Lines bytes already in memory, e.g. a shared
+            memory block mapped by several processes (see sharding.py).
+        '''
+
+        bank = cls.__new__(cls)
+        bank.file_name = None
+        bank.__setup(index, data, cache_size)
+        return bank
+
+    def __setup(self, index : np.ndarray, data, cache_size : int) -> None:
+
+        self.index = index
+        self.__data = data # mmap or buffer with the JSON Lines bytes
+
+        # ids sorted for lookup, positions point back into the index
+        self.__order = np.argsort(self.index["id"], kind="stable")
+        self.__sorted_ids = self.index["id"][self.__order]
+
+        pools = []
+        for difficulty in DIFFICULTIES:
+            ids = self.index["id"][self.index["difficulty"] == difficulty].astype(np.int64)
+            ids.flags.writeable = False
+            pools.append(ids)
+        self.pools = tuple(pools)
+        self.pool_ids = self.pools # large pools stay as arrays
+
+        self.get = lru_cache(maxsize=cache_size)(self.__materialize)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def by_id(self) -> Mapping[int, Mapping[str, Any]]:
+        raise AttributeError("LazyQuestionBank has no in memory id table, use get()")
+
+    def __materialize(self, question_id : int) -> Mapping[str, Any]:
+        '''parses one question from the file'''
+
+        pos = np.searchsorted(self.__sorted_ids, question_id)
+        if pos >= len(self.__sorted_ids) or self.__sorted_ids[pos] != question_id:
+            raise KeyError(question_id)
+
+        entry = self.index[self.__order[pos]]
+        start, stop = int(entry["offset"]), int(entry["offset"]) + int(entry["length"])
+        q = json.loads(bytes(self.__data[start:stop]))
+        q[DF] = int(entry["difficulty"])
+        return MappingProxyType(q)
+
+    def __load_index(self) -> np.ndarray:
+        '''cached offset index, rebuilt when the questions file changed'''
+
+        stat = os.stat(self.file_name)
+        index_path = self.file_name + ".idx.npz"
+
+        try:
+            with np.load(index_path) as cached:
+                if cached["source"].tolist() == [stat.st_size, stat.st_mtime_ns]:
+                    return cached["index"]
+        except (OSError, KeyError, ValueError):
+            pass
+
+        index = build_offset_index(self.file_name)
+        try:
+            with open(index_path + ".tmp", "wb") as f:
+                np.savez(f, index=index, source=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64))
+            os.replace(index_path + ".tmp", index_path)
+        except OSError as e:
+            print(f"Error: {e}, Writing: {index_path}")
+        return index
+
+
+def build_offset_index(file_name : str) -> np.ndarray:
+    '''one streaming pass over a JSON Lines questions file'''
+
+    entries = []
+    offset = 0
+    with open(file_name, "rb") as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped:
+                q = json.loads(stripped)
+                difficulty = q[DF] if isinstance(q[DF], int) else DIFF_MAP[q[DF]]
+                entries.append((q[ID], difficulty, offset, len(line)))
+            offset += len(line)
+    return np.array(entries, dtype=LazyQuestionBank.INDEX_DTYPE)
+
+def convert_to_jsonl(json_file : str, jsonl_file : str) -> int:
+    '''writes a {"low": [...], ...} questions file as JSON Lines, returns questions written'''
+
+    with open(json_file, "r") as jf:
+        data = json.load(jf)
+
+    count = 0
+    with open(jsonl_file, "w") as out:
+        for ability in COGNITIVE_ABILITIES_STRING:
+            for q in data.get(ability, []):
+                out.write(json.dumps(q) + "\n")
+                count += 1
+    return count
+
+def to_jsonl_bytes(bank : QuestionBank):
+    '''
+        (offset index, JSON Lines bytes) holding every question of bank,
+        the inputs of LazyQuestionBank.from_buffer
+    '''
+
+    if isinstance(bank, LazyQuestionBank) and bank.file_name:
+        with open(bank.file_name, "rb") as f:
+            return bank.index, f.read()
+
+    lines, entries, offset = [], [], 0
+    for difficulty in DIFFICULTIES:
+        for question_id in bank.pools[difficulty]:
+            line = (json.dumps(dict(bank.get(int(question_id)))) + "\n").encode("utf-8")
+            entries.append((int(question_id), difficulty, offset, len(line)))
+            lines.append(line)
+            offset += len(line)
+    return np.array(entries, dtype=LazyQuestionBank.INDEX_DTYPE), b"".join(lines)
+
+def load_question_bank(file_name : str) -> QuestionBank:
+    '''lazy bank for .jsonl files, in memory bank otherwise'''
+
+    if file_name.endswith(".jsonl"):
+        return LazyQuestionBank(file_name)
+    return QuestionBank.from_json(file_name)
+
+
+class QuestionDeck:
+    '''
+        One session's draw order over a shared QuestionBank. Uses a sparse
+        Fisher-Yates shuffle: each draw swaps a random undrawn position to
+        the cursor and only swapped positions are stored, so creating a
+        deck and drawing are O(1) whatever the pool size.
+    '''
+
+    __slots__ = ("bank", "randrange", "sizes", "cursors", "swaps")
+
+    def __init__(self, bank : QuestionBank, rng : Optional[random.Random] = None):
+
+        self.bank = bank
+        self.randrange = (rng or random).randrange
+        self.sizes = [bank.pool_size(d) for d in DIFFICULTIES]
+        self.cursors = [0] * len(DIFFICULTIES)
+        self.swaps = [{} for _ in DIFFICULTIES] # position -> pool index moved there
+
+    def remaining(self, difficulty : int) -> int:
+        '''questions of a difficulty not drawn yet'''
+        return self.sizes[difficulty] - self.cursors[difficulty]
+
+    def draw(self, difficulty : int) -> Optional[Mapping[str, Any]]:
+        '''next question of a difficulty, None when the pool is used up'''
+
+        cursor = self.cursors[difficulty]
+        if cursor >= self.sizes[difficulty]:
+            return None
+
+        # pick a random undrawn position and move the cursor's entry there
+        swaps = self.swaps[difficulty]
+        j = self.randrange(cursor, self.sizes[difficulty])
+        picked = swaps.get(j, j)
+        swaps[j] = swaps.pop(cursor, cursor)
+        self.cursors[difficulty] = cursor + 1
+
+        return self.bank.get(self.bank.pool_ids[difficulty][picked])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a questions JSON file to JSON Lines for lazy loading")
+    parser.add_argument("json_file", nargs="?", default="input/questions.json")
+    parser.add_argument("jsonl_file", nargs="?", default="input/questions.jsonl")
+    args = parser.parse_args()
+
+    print(f"Wrote {convert_to_jsonl(args.json_file, args.jsonl_file)} questions to {args.jsonl_file}")
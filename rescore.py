@@ -0,0 +1,154 @@
+# rescore.py
+# Author: Andrew Kelton
+
+'''
+Bulk re-scoring of every stored session with the current model.
+  * All answers come out of the feature cache as one stacked matrix,
+    one row per answer, with the row range of each session.
+  * One vectorized predict call labels every answer, then the majority
+    vote / undetermined outcome of every session is computed with
+    grouped NumPy operations.
+  * early_stop_replay() walks the same labels answer by answer with a
+    running tally and reports how many questions an engine.StoppingRule
+    would have saved and whether the results stay the same.
+'''
+
+from typing import Any, Dict
+import csv
+import time
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+from engine import UNDETERMINED
+import feature_cache
+
+DEFAULT_REPORT_PATH="rescore_report.csv"
+N_LABELS=len(COGNITIVE_ABILITIES_STRING)
+
+
+def label_codes_of(predictions : np.ndarray) -> np.ndarray:
+    '''label strings to COGNITIVE_ABILITIES_STRING indexes'''
+    labels = np.asarray(COGNITIVE_ABILITIES_STRING)
+    return np.argmax(np.asarray(predictions)[:, None] == labels[None, :], axis=1)
+
+def majority_outcomes(session_idx : np.ndarray, codes : np.ndarray, n_sessions : int):
+    '''
+        Per session prediction counts (n_sessions, N_LABELS), winning label
+        code and whether the winner is unique, same rule as
+        TestSession.final_result.
+    '''
+
+    counts = np.bincount(session_idx * N_LABELS + codes, minlength=n_sessions * N_LABELS)
+    counts = counts.reshape(n_sessions, N_LABELS)
+
+    top = counts.max(axis=1)
+    winner = counts.argmax(axis=1)
+    determined = (top > 0) & ((counts == top[:, None]).sum(axis=1) == 1)
+    return counts, winner, determined
+
+def rescore(predictor, parse_file, folder_path : str = "data",
+            cache_dir : str = feature_cache.DEFAULT_CACHE_DIR) -> Dict[str, Any]:
+    '''re-scores every session in folder_path, returns per session arrays and timings'''
+
+    start = time.perf_counter()
+    X, _ = feature_cache.load_X_y(parse_file, folder_path, cache_dir)
+    ranges = feature_cache.session_ranges(cache_dir)
+    loaded = time.perf_counter()
+
+    names = [name for name, _, _ in ranges]
+    lengths = np.array([stop - begin for _, begin, stop in ranges], dtype=np.intp)
+    session_idx = np.repeat(np.arange(len(ranges)), lengths)
+
+    codes = label_codes_of(predictor.predict(X)) if len(X) else np.empty(0, dtype=np.intp)
+    counts, winner, determined = majority_outcomes(session_idx, codes, len(ranges))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "names": names,
+        "answers": lengths,
+        "counts": counts,
+        "winner": winner,
+        "determined": determined,
+        "load_s": loaded - start,
+        "score_s": elapsed - (loaded - start),
+        "sessions_per_s": len(ranges) / elapsed if elapsed else 0.0
+    }
+
+def write_report(scores : Dict[str, Any], path : str = DEFAULT_REPORT_PATH) -> None:
+    '''one CSV row per session'''
+
+    results = np.where(scores["determined"],
+                       np.char.upper(np.asarray(COGNITIVE_ABILITIES_STRING)[scores["winner"]]),
+                       UNDETERMINED)
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["session", "answers"] + COGNITIVE_ABILITIES_STRING + ["result"])
+        for name, answers, counts, result in zip(scores["names"], scores["answers"].tolist(),
+                                                 scores["counts"].tolist(), results.tolist()):
+            writer.writerow([name, answers] + counts + [result])
+
+def summary(scores : Dict[str, Any]) -> str:
+    '''short text summary of a rescore'''
+
+    n = len(scores["names"])
+    determined = scores["determined"]
+    per_label = np.bincount(scores["winner"][determined], minlength=N_LABELS)
+    breakdown = ", ".join(f"{label}: {count}" for label, count in zip(COGNITIVE_ABILITIES_STRING, per_label.tolist()))
+    return (f"Rescored {n} sessions ({int(scores['answers'].sum())} answers) "
+            f"in {scores['load_s'] + scores['score_s']:.4f}s, {scores['sessions_per_s']:.0f} sessions/s\n"
+            f"Determined: {int(determined.sum())} ({breakdown}), undetermined: {n - int(determined.sum())}")
+
+def early_stop_replay(predictor, parse_file, rule, bank_size : int, folder_path : str = "data",
+                      cache_dir : str = feature_cache.DEFAULT_CACHE_DIR) -> Dict[str, Any]:
+    '''
+        Replays every stored session with the tally the engine keeps and
+        finds the first answer after which rule would have ended it.
+        bank_size is the number of questions a test can draw from.
+    '''
+
+    X, _ = feature_cache.load_X_y(parse_file, folder_path, cache_dir)
+    ranges = feature_cache.session_ranges(cache_dir)
+    codes = label_codes_of(predictor.predict(X)).tolist() if len(X) else []
+
+    lengths = np.array([stop - begin for _, begin, stop in ranges], dtype=np.intp)
+    session_idx = np.repeat(np.arange(len(ranges)), lengths)
+    _, full_winner, full_determined = majority_outcomes(session_idx, np.asarray(codes, dtype=np.intp), len(ranges))
+
+    stop_at, agree = [], []
+    for i, (_, begin, stop) in enumerate(ranges):
+        tally = [0] * N_LABELS
+        answered = stop - begin
+        for k, code in enumerate(codes[begin:stop], 1):
+            tally[code] += 1
+            if k < stop - begin and rule.should_stop(tally, k, bank_size - k):
+                answered = k
+                break
+
+        first, second = sorted(tally, reverse=True)[:2]
+        determined = first > second
+        agree.append(determined == bool(full_determined[i])
+                     and (not determined or tally.index(first) == int(full_winner[i])))
+        stop_at.append(answered)
+
+    stop_at = np.asarray(stop_at, dtype=np.intp)
+    n = len(ranges)
+    return {
+        "names": [name for name, _, _ in ranges],
+        "answers": lengths,
+        "stop_at": stop_at,
+        "agree": np.asarray(agree, dtype=bool),
+        "stopped_early": int((stop_at < lengths).sum()),
+        "saved_per_session": float((lengths - stop_at).mean()) if n else 0.0,
+        "saved_fraction": float((lengths - stop_at).sum() / lengths.sum()) if lengths.sum() else 0.0,
+        "agreement": float(np.mean(agree)) if n else 1.0
+    }
+
+def early_stop_summary(replay : Dict[str, Any]) -> str:
+    '''short text summary of an early stop replay'''
+
+    n = len(replay["names"])
+    return (f"Early stopping on {n} sessions: {replay['stopped_early']} ended early, "
+            f"{replay['saved_per_session']:.2f} questions saved per session ({replay['saved_fraction']:.1%} of answers), "
+            f"same result for {replay['agreement']:.1%}")
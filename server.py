@@ -0,0 +1,472 @@
+# server.py
+# Author: Andrew Kelton
+
+'''
+Asyncio HTTP/JSON server hosting many concurrent test sessions.
+  * One loaded model (Predictor) is shared by every session. With a
+    batching.BatchScheduler, next-question predictions of concurrent
+    sessions are made in one batched predict call.
+  * Endpoints:
+      POST /sessions                  start a session -> first question
+      GET  /sessions/<id>/next        current or next question
+      POST /sessions/<id>/answer      {"selected_answer", "time_taken"?, "render_latency"?}
+      GET  /sessions/<id>/result      final cognitive ability
+      GET  /metrics                   per route and engine stage latency, queue lag
+  * Running this file load tests a server already listening on localhost.
+'''
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import Counter, deque
+import asyncio
+import json
+import math
+import random
+import socket
+import time
+import uuid
+
+from constants import ID, QN, AN, AC, DF
+from engine import TestSession
+from instrumentation import TIMINGS
+from question_bank import QuestionBank
+
+DEFAULT_HOST="127.0.0.1"
+DEFAULT_PORT=8080
+SESSION_TTL=30 * 60      # seconds a session may sit idle
+LATENCY_WINDOW=10000     # latency samples kept per route
+MAX_BODY=64 * 1024
+
+HTTP_STATUS={200: "OK", 201: "Created", 307: "Temporary Redirect", 400: "Bad Request", 404: "Not Found",
+             409: "Conflict", 413: "Payload Too Large"}
+
+
+class HTTPError(Exception):
+    '''error response with a status code and optional extra headers'''
+
+    def __init__(self, status : int, message : str, headers : Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+def seconds_field(body : Dict[str, Any], key : str) -> Optional[float]:
+    '''body[key] as seconds, None if absent. Anything but a finite number >= 0 is a 400'''
+
+    value = body.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise HTTPError(400, f"{key} must be a finite number >= 0")
+    return float(value)
+
+
+def percentile(samples, q : float) -> float:
+    '''q-th percentile of samples, nearest rank'''
+
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class Metrics:
+    '''per route request latency and session throughput'''
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.latencies = {}
+        self.requests = Counter()
+        self.sessions_started = 0
+        self.sessions_finished = 0
+        self.finished_times = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, route : str, seconds : float) -> None:
+        self.requests[route] += 1
+        self.latencies.setdefault(route, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def session_finished(self) -> None:
+        self.sessions_finished += 1
+        self.finished_times.append(time.perf_counter())
+
+    def snapshot(self, active_sessions : int) -> Dict[str, Any]:
+        '''metrics as a JSON ready dict, latencies in milliseconds'''
+
+        now = time.perf_counter()
+        uptime = now - self.started_at
+        recent = [t for t in self.finished_times if now - t <= 10]
+
+        routes = {}
+        for route, samples in self.latencies.items():
+            routes[route] = {
+                "count": self.requests[route],
+                "mean_ms": sum(samples) / len(samples) * 1e3,
+                "p50_ms": percentile(samples, 50) * 1e3,
+                "p95_ms": percentile(samples, 95) * 1e3,
+                "p99_ms": percentile(samples, 99) * 1e3
+            }
+
+        return {
+            "uptime_s": uptime,
+            "active_sessions": active_sessions,
+            "sessions_started": self.sessions_started,
+            "sessions_finished": self.sessions_finished,
+            "sessions_per_s": self.sessions_finished / uptime if uptime else 0.0,
+            "sessions_per_s_10s": len(recent) / min(10, uptime) if uptime else 0.0,
+            "routes": routes
+        }
+
+
+def public_question(question : Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''question without its answer'''
+
+    if question is None:
+        return None
+    return {ID: question[ID], QN: question[QN], AC: question[AC], DF: question[DF]}
+
+
+class TestServer:
+
+    def __init__(self,
+                 question_bank : QuestionBank,
+                 predictor,
+                 on_finished : Optional[Callable[[TestSession], None]] = None,
+                 online = None,
+                 lag : Optional[Dict[str, Callable[[], Dict[str, Any]]]] = None,
+                 worker_id : Optional[int] = None,
+                 worker_urls : Optional[List[str]] = None,
+                 batcher = None,
+                 policy = None,
+                 stopping = None
+                ):
+
+        self.question_bank = question_bank # one read only bank shared by all sessions
+        self.predictor = predictor     # one model shared by all sessions
+        self.on_finished = on_finished # called once per completed session
+        self.online = online           # optional online.OnlineUpdater fed by finished sessions
+        self.lag = lag or {}           # name -> lag() of background queues, see background.py
+        self.batcher = batcher         # optional batching.BatchScheduler over predictor
+        self.policy = policy           # optional policy.Policy, sessions route without the model
+        self.stopping = stopping       # optional engine.StoppingRule, ends tests early
+        self.sessions = {}             # session id -> [TestSession, last used, served at]
+        self.metrics = Metrics()
+
+        # sharded mode, see sharding.py: session ids start with the owning worker
+        self.worker_id = worker_id
+        self.worker_urls = worker_urls or []
+        self.session_prefix = f"{worker_id:x}-" if worker_id is not None else ""
+
+    # ---- session endpoints ----
+
+    def start_session(self, body : Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        username = body.get("username")
+        if username is not None and not isinstance(username, str):
+            raise HTTPError(400, "username must be a string")
+
+        session = TestSession(self.question_bank, self.predictor, username=username,
+                              policy=self.policy, stopping=self.stopping)
+        session_id = self.session_prefix + uuid.uuid4().hex
+        now = time.perf_counter()
+        self.sessions[session_id] = [session, now, now]
+        self.metrics.sessions_started += 1
+
+        question = session.next_question()
+        return 201, {"session_id": session_id, "question": public_question(question)}
+
+    async def next_question(self, session_id : str) -> Tuple[int, Dict[str, Any]]:
+        entry = self.__get(session_id)
+        session = entry[0]
+
+        # predict together with the other sessions waiting for a question
+        row = session.pending_row() if self.batcher is not None else None
+        prediction = await self.batcher.predict_one(row) if row is not None else None
+
+        served = session.current_question
+        question = session.next_question(prediction)
+        if question is not served:
+            entry[2] = time.perf_counter() # start timing when a new question is served
+
+        return 200, {
+            "question": public_question(question),
+            "finished": session.finished,
+            "predicted_difficulty": session.predicted_difficulty,
+            "question_count": session.question_count
+        }
+
+    def answer(self, session_id : str, body : Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        entry = self.__get(session_id)
+        session = entry[0]
+
+        if "selected_answer" not in body:
+            raise HTTPError(400, "selected_answer is required")
+        if session.current_question is None:
+            raise HTTPError(409, "no question to answer, call next first")
+
+        # clients may report their own response time, else time since it was served
+        time_taken = seconds_field(body, "time_taken")
+        if time_taken is None:
+            time_taken = time.perf_counter() - entry[2]
+        render_latency = seconds_field(body, "render_latency") # measured by the client, if it can
+
+        correct_answer = session.current_question[AN]
+        correct = session.submit_answer(body["selected_answer"], time_taken, render_latency)
+        return 200, {"correct": correct, "correct_answer": correct_answer}
+
+    def result(self, session_id : str) -> Tuple[int, Dict[str, Any]]:
+        session = self.__get(session_id)[0]
+        if not session.finished:
+            raise HTTPError(409, "session has unanswered questions")
+
+        result = session.final_result()
+        del self.sessions[session_id]
+        self.metrics.session_finished()
+        if self.on_finished is not None:
+            self.on_finished(session)
+        if self.online is not None:
+            self.online.submit(session)
+
+        return 200, {
+            "result": result,
+            "determined": session.determined,
+            "stopped_early": session.stopped_early,
+            "prediction_counts": dict(session.prediction_counts),
+            "answers": len(session.answers)
+        }
+
+    def __get(self, session_id : str) -> list:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            raise HTTPError(404, f"unknown session '{session_id}'")
+        entry[1] = time.perf_counter()
+        return entry
+
+    def owner_of(self, session_id : str) -> Optional[int]:
+        '''worker that holds a session in sharded mode, None otherwise'''
+
+        if self.worker_id is None:
+            return None
+        prefix, sep, _ = session_id.partition("-")
+        try:
+            return int(prefix, 16) if sep else None
+        except ValueError:
+            return None
+
+    def expire_sessions(self) -> int:
+        '''drops sessions idle for longer than SESSION_TTL'''
+
+        now = time.perf_counter()
+        expired = [sid for sid, entry in self.sessions.items() if now - entry[1] > SESSION_TTL]
+        for sid in expired:
+            del self.sessions[sid]
+        return len(expired)
+
+    # ---- http ----
+
+    async def route(self, method : str, path : str, body : Dict[str, Any]) -> Tuple[str, int, Dict[str, Any]]:
+        '''dispatches a request, returns (route name, status, payload)'''
+
+        parts = [p for p in path.split("?")[0].split("/") if p]
+
+        if method == "POST" and parts == ["sessions"]:
+            return ("start", *self.start_session(body))
+        if method == "GET" and parts == ["metrics"]:
+            snapshot = self.metrics.snapshot(len(self.sessions))
+            if self.online is not None:
+                snapshot["online"] = dict(self.online.stats(), model_version=self.predictor.version)
+            if getattr(self.predictor, "cache", None) is not None:
+                snapshot["prediction_cache"] = self.predictor.cache.stats()
+            if self.policy is not None:
+                snapshot["policy"] = self.policy.meta
+            if self.batcher is not None:
+                snapshot["batching"] = self.batcher.stats()
+            if self.lag:
+                snapshot["queues"] = {name: lag() for name, lag in self.lag.items()}
+            snapshot["stages"] = TIMINGS.summary()
+            return ("metrics", 200, snapshot)
+
+        if len(parts) == 3 and parts[0] == "sessions":
+            session_id, action = parts[1], parts[2]
+
+            # another worker's session, send the client to that worker
+            owner = self.owner_of(session_id)
+            if owner is not None and owner != self.worker_id and owner < len(self.worker_urls):
+                raise HTTPError(307, f"session '{session_id}' lives on worker {owner}",
+                                {"Location": self.worker_urls[owner] + path})
+            if method == "GET" and action == "next":
+                return ("next", *await self.next_question(session_id))
+            if method == "POST" and action == "answer":
+                return ("answer", *self.answer(session_id, body))
+            if method == "GET" and action == "result":
+                return ("result", *self.result(session_id))
+
+        raise HTTPError(404, f"no route for {method} {path}")
+
+    async def handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        '''serves HTTP/1.1 requests on one keep-alive connection'''
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                start = time.perf_counter()
+                request = request_line.decode("latin-1").split(" ", 2)
+                if len(request) != 3:
+                    # not HTTP, answer once and drop the connection
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    break
+                method, path, _ = request
+
+                # headers
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                route_name = "error"
+                extra_headers = ""
+                try:
+                    try:
+                        length = int(headers.get("content-length", 0))
+                    except ValueError:
+                        raise HTTPError(400, "invalid Content-Length")
+                    if length < 0:
+                        raise HTTPError(400, "invalid Content-Length")
+                    if length > MAX_BODY:
+                        raise HTTPError(413, "request body too large")
+                    raw = await reader.readexactly(length) if length else b""
+
+                    try:
+                        body = json.loads(raw) if raw else {}
+                    except ValueError:
+                        raise HTTPError(400, "body is not valid JSON")
+                    if not isinstance(body, dict):
+                        raise HTTPError(400, "body must be a JSON object")
+
+                    route_name, status, payload = await self.route(method, path, body)
+
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                    extra_headers = "".join(f"{key}: {value}\r\n" for key, value in e.headers.items())
+                    if "Location" in e.headers:
+                        payload["location"] = e.headers["Location"]
+
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\n"
+                    f"Content-Type: application/json\r\n{extra_headers}"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                self.metrics.record(route_name, time.perf_counter() - start)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host : str = DEFAULT_HOST, port : int = DEFAULT_PORT,
+                    sockets : Optional[List[socket.socket]] = None) -> None:
+        '''runs the server until cancelled, on already bound sockets if given'''
+
+        if sockets:
+            servers = [await asyncio.start_server(self.handle_connection, sock=sock) for sock in sockets]
+        else:
+            servers = [await asyncio.start_server(self.handle_connection, host, port)]
+            print(f"Serving cognitive tests on http://{host}:{port}")
+
+        try:
+            while True:
+                await asyncio.sleep(60)
+                self.expire_sessions()
+        finally:
+            for server in servers:
+                server.close()
+
+
+# ---- localhost load test ----
+
+async def http_json(reader : asyncio.StreamReader, writer : asyncio.StreamWriter,
+                    method : str, path : str, body : Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    '''one request on a keep-alive connection'''
+
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+    )
+    await writer.drain()
+
+    await reader.readline() # status line
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return json.loads(await reader.readexactly(length))
+
+async def run_client(host : str, port : int, n_sessions : int) -> int:
+    '''completes n_sessions tests answering at random, returns answers given'''
+
+    reader, writer = await asyncio.open_connection(host, port)
+    answers = 0
+    try:
+        for _ in range(n_sessions):
+            started = await http_json(reader, writer, "POST", "/sessions", {}) # anonymous, never saved
+            sid, question = started["session_id"], started["question"]
+            while question is not None:
+                await http_json(reader, writer, "POST", f"/sessions/{sid}/answer", {
+                    "selected_answer": random.choice(question[AC]),
+                    "time_taken": random.uniform(1, 12)
+                })
+                answers += 1
+                question = (await http_json(reader, writer, "GET", f"/sessions/{sid}/next"))["question"]
+            await http_json(reader, writer, "GET", f"/sessions/{sid}/result")
+    finally:
+        writer.close()
+    return answers
+
+async def load_test(host : str = DEFAULT_HOST, port : int = DEFAULT_PORT,
+                    sessions : int = 1000, concurrency : int = 50) -> Dict[str, Any]:
+    '''drives sessions tests over concurrency connections and fetches server metrics'''
+
+    start = time.perf_counter()
+    per_client = [sessions // concurrency + (i < sessions % concurrency) for i in range(concurrency)]
+    answers = sum(await asyncio.gather(*(run_client(host, port, n) for n in per_client if n)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    metrics = await http_json(reader, writer, "GET", "/metrics")
+    writer.close()
+
+    return {
+        "sessions": sessions,
+        "answers": answers,
+        "elapsed_s": elapsed,
+        "client_sessions_per_s": sessions / elapsed,
+        "client_answers_per_s": answers / elapsed,
+        "server": metrics
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test a running cognitive test server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(load_test(args.host, args.port, args.sessions, args.concurrency)), indent=4))
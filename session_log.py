@@ -0,0 +1,355 @@
+# session_log.py
+# Author: Andrew Kelton
+
+'''
+Append-only binary log of completed test sessions.
+  * data/sessions.log holds one length prefixed record per session:
+      <I length> <session header> <answer records> <selected answers> <I crc32>
+    where every answer is a fixed width 19 byte struct
+    (id, result, difficulty, time_taken, predicted label code,
+    render_latency, NaN if unknown).
+  * data/sessions.idx holds fixed width (session id, offset) entries
+    for random access and is rebuilt from the log if it falls behind.
+  * Appends are one write of a whole record under a lock, so concurrent
+    sessions can stream into the same log.
+  * Version 1 logs (no render_latency) are still read, with NaN render
+    latencies, and are rewritten as the current version before the
+    first append.
+  * Running this file migrates the old data/*_answers.json files.
+'''
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+
+try:
+    import fcntl # cross process append lock, not available on windows
+except ImportError:
+    fcntl = None
+
+DEFAULT_LOG_PATH="data/sessions.log"
+LOG_MAGIC=b"CGSL"
+LOG_VERSION=2
+
+FILE_HEADER=struct.Struct("<4sH2x")      # magic, version
+LENGTH=struct.Struct("<I")               # record payload length / crc32
+SESSION_HEADER=struct.Struct("<16sqH32s") # session id, unix time ns, answer count, username
+INDEX_ENTRY=struct.Struct("<16sQ")       # session id, record offset
+USERNAME_BYTES=32
+NO_LABEL=-1
+NO_ID=-1 # answers recorded without a question id
+
+# fixed width answer record, packed
+ANSWER_DTYPE=np.dtype([
+    ("id", "<i4"),
+    ("result", "u1"),
+    ("difficulty", "u1"),
+    ("time_taken", "<f8"),
+    ("predicted", "i1"),
+    ("render_latency", "<f4")
+])
+ANSWER_DTYPES={1: np.dtype(ANSWER_DTYPE.descr[:-1]), 2: ANSWER_DTYPE} # log version -> answer record
+
+
+class SessionRecord(NamedTuple):
+    session_id : str
+    username : str
+    timestamp_ns : int
+    answers : np.ndarray        # ANSWER_DTYPE
+    selected_answers : List[Any]
+    offset : int
+
+    def answers_list(self) -> List[Dict[str, Any]]:
+        '''answers in the same dict form TestSession.answers_list uses'''
+
+        return [{
+            "id": int(a["id"]),
+            "selected_answer": selected,
+            "result": int(a["result"]),
+            "difficulty": int(a["difficulty"]),
+            "time_taken": float(a["time_taken"]),
+            "render_latency": None if np.isnan(a["render_latency"]) else float(a["render_latency"]),
+            "predicted_difficulty": COGNITIVE_ABILITIES_STRING[a["predicted"]] if a["predicted"] != NO_LABEL else None
+        } for a, selected in zip(self.answers, self.selected_answers)]
+
+
+def encode_answers(answers_list : List[Dict[str, Any]]) -> np.ndarray:
+    '''answer dicts to ANSWER_DTYPE records'''
+
+    codes = {label: i for i, label in enumerate(COGNITIVE_ABILITIES_STRING)}
+    answers = np.empty(len(answers_list), dtype=ANSWER_DTYPE)
+    for i, a in enumerate(answers_list):
+        render_latency = a.get("render_latency")
+        answers[i] = (a.get("id", NO_ID), a["result"], a["difficulty"], a["time_taken"],
+                      codes.get(a.get("predicted_difficulty"), NO_LABEL),
+                      np.nan if render_latency is None else render_latency)
+    return answers
+
+def valid_answers(answers_list : List[Dict[str, Any]], source : str = "") -> List[Dict[str, Any]]:
+    '''the entries encode_answers can store, bad ones are skipped one at a time like the training reader does'''
+
+    kept = []
+    for answer in answers_list:
+        try:
+            encode_answers([answer])
+        except (KeyError, ValueError, TypeError, OverflowError, AttributeError) as e:
+            print(f"Skipping bad entry in {source}: {e}")
+            continue
+        kept.append(answer)
+    return kept
+
+def encode_record(session_id : bytes, answers_list : List[Dict[str, Any]],
+                  username : Optional[str] = None, timestamp_ns : Optional[int] = None) -> bytes:
+    '''one complete length prefixed record, answers_list may also be an answers.AnswerLog'''
+
+    if hasattr(answers_list, "persisted"): # already packed records
+        answers = answers_list.persisted()
+        selected = json.dumps(answers_list.selected).encode("utf-8")
+    else:
+        answers = encode_answers(answers_list)
+        selected = json.dumps([a.get("selected_answer") for a in answers_list]).encode("utf-8")
+    name = (username or "").encode("utf-8")[:USERNAME_BYTES]
+
+    payload = SESSION_HEADER.pack(session_id, timestamp_ns or time.time_ns(), len(answers), name) \
+        + answers.tobytes() + selected
+    return LENGTH.pack(len(payload)) + payload + LENGTH.pack(zlib.crc32(payload))
+
+def decode_record(payload : bytes, offset : int, version : int = LOG_VERSION) -> SessionRecord:
+    '''SessionRecord from a record payload written by a version log'''
+
+    session_id, timestamp_ns, n, name = SESSION_HEADER.unpack_from(payload)
+    dtype = ANSWER_DTYPES[version]
+    start = SESSION_HEADER.size
+    stop = start + n * dtype.itemsize
+    answers = np.frombuffer(payload, dtype=dtype, count=n, offset=start)
+    if dtype is not ANSWER_DTYPE: # older record, fields it lacks are unknown
+        upgraded = np.empty(n, dtype=ANSWER_DTYPE)
+        upgraded["render_latency"] = np.nan
+        for field in dtype.names:
+            upgraded[field] = answers[field]
+        answers = upgraded
+    return SessionRecord(
+        session_id.hex(),
+        name.rstrip(b"\0").decode("utf-8", "replace"),
+        timestamp_ns,
+        answers,
+        json.loads(payload[stop:]),
+        offset
+    )
+
+
+class SessionLog:
+
+    def __init__(self, path : str = DEFAULT_LOG_PATH):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + ".idx"
+        self.lock = threading.Lock()
+        self.index = None # session id bytes -> offset, loaded lazily
+        self.upgraded = False # the log on disk was checked to be the current version
+
+    # ---- writing ----
+
+    def append(self, answers_list : List[Dict[str, Any]], username : Optional[str] = None,
+               session_id : Optional[str] = None, timestamp_ns : Optional[int] = None) -> str:
+        '''appends one session, returns its id'''
+
+        sid = bytes.fromhex(session_id) if session_id else uuid.uuid4().bytes
+        record = encode_record(sid, answers_list, username, timestamp_ns)
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock:
+            if not self.upgraded:
+                self.__upgrade()
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                offset = os.fstat(fd).st_size
+                if offset == 0:
+                    os.write(fd, FILE_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+                    offset = FILE_HEADER.size
+                os.write(fd, record)
+
+                # index entry goes in after the record is on disk
+                with open(self.index_path, "ab") as idx:
+                    idx.write(INDEX_ENTRY.pack(sid, offset))
+            finally:
+                os.close(fd) # closing releases the flock
+
+            if self.index is not None:
+                self.index[sid] = offset
+
+        return sid.hex()
+
+    def __upgrade(self) -> None:
+        '''rewrites an older version log as the current version, the index is rebuilt on next use'''
+
+        version = self.version()
+        if version is not None and version != LOG_VERSION:
+            records = list(self.scan())
+            with open(self.path + ".tmp", "wb") as f:
+                f.write(FILE_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+                for r in records:
+                    f.write(encode_record(bytes.fromhex(r.session_id), r.answers_list(), r.username, r.timestamp_ns))
+            os.replace(self.path + ".tmp", self.path)
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            self.index = None
+        self.upgraded = True
+
+    # ---- reading ----
+
+    def version(self) -> Optional[int]:
+        '''format version of the log on disk, None if it is missing or empty'''
+
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            return None
+        magic, version = FILE_HEADER.unpack(header)
+        if magic != LOG_MAGIC or version not in ANSWER_DTYPES:
+            raise ValueError(f"{self.path} is not a version {LOG_VERSION} session log")
+        return version
+
+    def scan(self, start : int = 0) -> Iterator[SessionRecord]:
+        '''
+            Yields every complete record from byte offset start on. A torn
+            or corrupt record at the end of the log stops the scan.
+        '''
+        for record, _ in self.scan_with_offsets(start):
+            yield record
+
+    def scan_with_offsets(self, start : int = 0) -> Iterator[Tuple[SessionRecord, int]]:
+        '''like scan, also yields the offset just past each record'''
+
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                return
+            magic, version = FILE_HEADER.unpack(header)
+            if magic != LOG_MAGIC or version not in ANSWER_DTYPES:
+                raise ValueError(f"{self.path} is not a version {LOG_VERSION} session log")
+
+            offset = max(start, FILE_HEADER.size)
+            f.seek(offset)
+            while True:
+                prefix = f.read(LENGTH.size)
+                if len(prefix) < LENGTH.size:
+                    return
+                (length,) = LENGTH.unpack(prefix)
+                payload = f.read(length)
+                crc = f.read(LENGTH.size)
+                if len(payload) < length or len(crc) < LENGTH.size or LENGTH.unpack(crc)[0] != zlib.crc32(payload):
+                    return
+
+                end = offset + LENGTH.size + length + LENGTH.size
+                yield decode_record(payload, offset, version), end
+                offset = end
+
+    def read_at(self, offset : int) -> SessionRecord:
+        '''the record starting at offset'''
+
+        version = self.version()
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            (length,) = LENGTH.unpack(f.read(LENGTH.size))
+            payload = f.read(length)
+            (crc,) = LENGTH.unpack(f.read(LENGTH.size))
+        if crc != zlib.crc32(payload):
+            raise ValueError(f"Corrupt session record at offset {offset} in {self.path}")
+        return decode_record(payload, offset, version)
+
+    def get(self, session_id : str) -> Optional[SessionRecord]:
+        '''random access by session id, None if unknown'''
+
+        offset = self.load_index().get(bytes.fromhex(session_id))
+        return None if offset is None else self.read_at(offset)
+
+    def __contains__(self, session_id : str) -> bool:
+        return bytes.fromhex(session_id) in self.load_index()
+
+    def load_index(self) -> Dict[bytes, int]:
+        '''reads the index, rebuilding it from the log if it is missing or behind'''
+
+        if self.index is not None:
+            return self.index
+
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            for sid, offset in INDEX_ENTRY.iter_unpack(data[:usable]):
+                index[sid] = offset
+
+        # appends since the last index entry, or no index at all
+        last = max(index.values(), default=0)
+        missing = [(bytes.fromhex(r.session_id), r.offset) for r in self.scan(last) if r.offset > last or not index]
+        if missing:
+            with self.lock, open(self.index_path, "ab") as f:
+                for sid, offset in missing:
+                    f.write(INDEX_ENTRY.pack(sid, offset))
+                    index[sid] = offset
+
+        self.index = index
+        return index
+
+
+def migrate_json(folder_path : str = "data", log : Optional[SessionLog] = None,
+                 archive_dir : Optional[str] = None) -> int:
+    '''
+        One time import of data/*_answers.json into the session log. Each
+        file gets a session id derived from its name, so running it again
+        skips files already migrated. Migrated files are moved to
+        data/migrated so they are not read twice. Returns sessions added.
+    '''
+
+    log = log or SessionLog(os.path.join(folder_path, os.path.basename(DEFAULT_LOG_PATH)))
+    archive_dir = archive_dir or os.path.join(folder_path, "migrated")
+    added = 0
+
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith(".json"):
+            continue
+
+        file_path = os.path.join(folder_path, filename)
+        session_id = uuid.uuid5(uuid.NAMESPACE_URL, filename).hex
+        if session_id not in log:
+            try:
+                with open(file_path, "r") as jf:
+                    answers_list = valid_answers(json.load(jf), filename)
+                username = filename[:-len("_answers.json")] if filename.endswith("_answers.json") else filename[:-5]
+                log.append(answers_list, username, session_id, os.stat(file_path).st_mtime_ns)
+                added += 1
+            except Exception as e:
+                print(f"Error: {e}, Migrating: {file_path}")
+                continue
+
+        os.makedirs(archive_dir, exist_ok=True)
+        os.replace(file_path, os.path.join(archive_dir, filename))
+
+    return added
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Migrate data/*_answers.json into the session log")
+    parser.add_argument("--folder", default="data")
+    args = parser.parse_args()
+
+    print(f"Migrated {migrate_json(args.folder)} sessions")
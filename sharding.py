@@ -0,0 +1,290 @@
+# sharding.py
+# Author: Andrew Kelton
+
+'''
+Pre-fork multi-process serving, so per answer prediction and feature
+work is not limited to one core by the GIL.
+  * The parent loads the model and question bank once and copies them
+    into shared memory: the compiled tree arrays, and the bank as JSON
+    Lines bytes plus its offset index.
+  * Listening sockets are bound before forking. Every worker maps the
+    shared blocks read only (CompiledTree.from_arrays,
+    LazyQuestionBank.from_buffer), accepts on the shared port and also
+    listens on its own port (port + 1 + worker).
+  * Session ids start with the owning worker. A request that reaches
+    another worker is answered with a 307 redirect to the owner's port.
+    Keep-alive clients stay on one worker and are never redirected.
+  * Running this file benchmarks sessions/s against the worker count.
+'''
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from multiprocessing import shared_memory
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import numpy as np
+
+import background
+from batching import BatchScheduler, DEFAULT_MAX_BATCH
+from compiled_tree import CompiledTree, Predictor
+from question_bank import QuestionBank, LazyQuestionBank, to_jsonl_bytes
+from server import TestServer, DEFAULT_HOST, DEFAULT_PORT
+
+ALIGN=64 # bytes, start of every array in a shared block
+
+
+def share_arrays(arrays : Dict[str, np.ndarray]) -> Tuple[shared_memory.SharedMemory, Dict[str, np.ndarray]]:
+    '''copies arrays into one shared memory block, returns it and read only views into it'''
+
+    layout, size = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        size = -(-size // ALIGN) * ALIGN
+        layout[name] = (array, size)
+        size += array.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    views = {}
+    for name, (array, offset) in layout.items():
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=offset)
+        view[...] = array
+        view.flags.writeable = False
+        views[name] = view
+    return block, views
+
+
+def _worker_main(worker_id : int, sockets : List[socket.socket], model_views : Dict[str, np.ndarray],
+                 bank_views : Dict[str, np.ndarray], predict_mode : str, worker_urls : List[str],
+                 on_finished : Optional[Callable[[Any], None]], log_level : str,
+                 batch : Optional[Tuple[float, int]], cache_size : int, policy, stopping) -> None:
+    '''one forked worker: builds its view of the shared model and bank and serves'''
+
+    # Ctrl+C reaches the whole process group, the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # threads are not forked, so the log writer and session writer start here
+    log_listener = background.setup_logging(log_level)
+    session_writer = background.SessionWriter(on_finished) if on_finished else None
+
+    predictor = Predictor(CompiledTree.from_arrays(model_views), predict_mode, cache_size)
+    bank = LazyQuestionBank.from_buffer(bank_views["index"], bank_views["data"])
+    batcher = BatchScheduler(predictor, *batch) if batch is not None else None
+
+    test_server = TestServer(bank, predictor,
+                             on_finished=session_writer.submit if session_writer else None,
+                             lag={"sessions": session_writer.lag} if session_writer else None,
+                             worker_id=worker_id,
+                             worker_urls=worker_urls,
+                             batcher=batcher,
+                             policy=policy,
+                             stopping=stopping)
+
+    async def serve() -> None:
+        # SIGTERM from the parent cancels the server task, a clean shutdown
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await test_server.serve(sockets=sockets)
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if session_writer is not None:
+            session_writer.stop()
+        log_listener.stop()
+
+
+class ShardedServer:
+    '''
+        Parent of the worker pool. start() shares the model and bank,
+        binds the sockets and forks; stop() terminates the workers and
+        frees the shared memory.
+    '''
+
+    def __init__(self,
+                 question_bank : QuestionBank,
+                 model,
+                 workers : Optional[int] = None,
+                 host : str = DEFAULT_HOST,
+                 port : int = DEFAULT_PORT,
+                 predict_mode : str = "tree",
+                 on_finished : Optional[Callable[[Any], None]] = None,
+                 log_level : str = background.DEFAULT_LOG_LEVEL,
+                 batch_window_ms : Optional[float] = None,
+                 batch_size : int = DEFAULT_MAX_BATCH,
+                 cache_size : int = 0,
+                 policy = None,
+                 stopping = None
+                ):
+
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Sharded serving needs fork(), it is not available on this platform")
+        if not isinstance(model, CompiledTree) and not hasattr(model, "tree_"):
+            raise ValueError("Sharded serving needs a single decision tree model")
+
+        self.question_bank = question_bank
+        self.model = model
+        self.workers = workers or os.cpu_count() or 1
+        self.host = host
+        self.port = port
+        self.predict_mode = predict_mode
+        self.on_finished = on_finished  # called in the worker that finished the session
+        self.log_level = log_level
+        self.batch = (batch_window_ms, batch_size) if batch_window_ms is not None else None # per worker
+        self.cache_size = cache_size # prediction cache entries per worker
+        self.policy = policy         # small and read only, inherited by the fork
+        self.stopping = stopping
+
+        self.blocks = []     # shared memory, owned by the parent
+        self.sockets = []
+        self.processes = []
+
+    def worker_urls(self) -> List[str]:
+        return [f"http://{self.host}:{self.port + 1 + i}" for i in range(self.workers)]
+
+    def start(self) -> "ShardedServer":
+
+        compiled = self.model if isinstance(self.model, CompiledTree) else CompiledTree(self.model)
+        index, data = to_jsonl_bytes(self.question_bank)
+
+        model_block, model_views = share_arrays(compiled.arrays())
+        bank_block, bank_views = share_arrays({"index": index, "data": np.frombuffer(data, dtype=np.uint8)})
+        self.blocks = [model_block, bank_block]
+
+        shared = self.__listen(self.port)
+        urls = self.worker_urls()
+
+        context = multiprocessing.get_context("fork")
+        for worker_id in range(self.workers):
+            own = self.__listen(self.port + 1 + worker_id)
+            process = context.Process(target=_worker_main, name=f"test-worker-{worker_id}", daemon=True,
+                                      args=(worker_id, [shared, own], model_views, bank_views,
+                                            self.predict_mode, urls, self.on_finished, self.log_level,
+                                            self.batch, self.cache_size, self.policy, self.stopping))
+            process.start()
+            self.processes.append(process)
+
+        print(f"Serving cognitive tests on http://{self.host}:{self.port} with {self.workers} workers "
+              f"(shared model {model_block.size} B, bank {bank_block.size} B)")
+        return self
+
+    def __listen(self, port : int) -> socket.socket:
+        '''bound, listening socket that the workers inherit'''
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        self.sockets.append(sock)
+        return sock
+
+    def wait(self) -> None:
+        '''blocks until every worker has exited'''
+        for process in self.processes:
+            process.join()
+
+    def stop(self) -> None:
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(5)
+        for sock in self.sockets:
+            sock.close()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.processes, self.sockets, self.blocks = [], [], []
+
+
+# ---- scaling benchmark ----
+
+def _client_main(host : str, port : int, n_sessions : int, concurrency : int) -> int:
+    '''one load generating process, returns answers given'''
+    from server import run_client
+
+    async def drive() -> int:
+        per_client = [n_sessions // concurrency + (i < n_sessions % concurrency) for i in range(concurrency)]
+        return sum(await asyncio.gather(*(run_client(host, port, n) for n in per_client if n)))
+
+    return asyncio.run(drive())
+
+
+def scaling_benchmark(question_bank : QuestionBank, model, worker_counts : List[int],
+                      sessions : int = 2000, concurrency : int = 32, clients : Optional[int] = None,
+                      host : str = DEFAULT_HOST, port : int = 8090) -> List[Dict[str, Any]]:
+    '''
+        Sessions/s of a sharded server for each worker count. Load comes
+        from `clients` processes (default one per worker) sharing the
+        sessions and connections, all on this machine.
+    '''
+
+    results = []
+    for workers in worker_counts:
+        sharded = ShardedServer(question_bank, model, workers, host, port, log_level="WARNING").start()
+        try:
+            n_clients = clients or workers
+            shares = [(host, port, sessions // n_clients + (i < sessions % n_clients),
+                       max(1, concurrency // n_clients)) for i in range(n_clients)]
+
+            start = time.perf_counter()
+            with multiprocessing.get_context("fork").Pool(n_clients) as pool:
+                answers = sum(pool.starmap(_client_main, shares))
+            elapsed = time.perf_counter() - start
+        finally:
+            sharded.stop()
+
+        rate = sessions / elapsed
+        speedup = rate / results[0]["sessions_per_s"] if results else 1.0
+        results.append({
+            "workers": workers,
+            "sessions": sessions,
+            "answers": answers,
+            "elapsed_s": elapsed,
+            "sessions_per_s": rate,
+            "speedup": speedup,                                  # against the first worker count
+            "efficiency": speedup * worker_counts[0] / workers   # 1.0 is linear scaling
+        })
+        port += workers + 1 # fresh ports, no TIME_WAIT clashes
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import main
+
+    parser = argparse.ArgumentParser(description="Sessions/s of the pre-fork server against worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="worker counts to try, defaults to 1, 2, 4 ... up to the core count")
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32, help="client connections in total")
+    parser.add_argument("--clients", type=int, default=None, help="client processes, default one per worker")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    counts = args.workers or sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+
+    question_bank = main.get_question_bank("input/questions.json")
+    model = main.get_fast_model() or main.get_model()
+    results = scaling_benchmark(question_bank, model, counts, args.sessions, args.concurrency,
+                                args.clients, port=args.port)
+
+    print(f"{'workers':>8} {'sessions/s':>12} {'speedup':>8} {'efficiency':>10}   ({cores} cores)")
+    for r in results:
+        print(f"{r['workers']:>8} {r['sessions_per_s']:>12.0f} {r['speedup']:>8.2f} {r['efficiency']:>10.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cores": cores, "results": results}, f, indent=4)
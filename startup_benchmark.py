@@ -0,0 +1,101 @@
+# startup_benchmark.py
+# Author: Andrew Kelton
+
+'''
+Startup benchmark for main.py.
+  * Time to ready: fresh interpreters load the model and build the
+    Predictor the normal way (fingerprint check, stored sklearn model)
+    and the fast start way (compiled tree, no sklearn). Reports the
+    median wall clock of several runs and which heavy packages got
+    imported.
+  * Import breakdown: runs both under `python -X importtime` and sums
+    the cumulative import time of every top level package.
+'''
+
+from typing import Any, Dict
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY=("sklearn", "scipy", "tkinter", "matplotlib")
+
+READY_SCRIPT='''
+import sys, time, json
+start = time.perf_counter()
+import main
+from compiled_tree import Predictor
+model = main.get_fast_model() if {fast} else None
+if model is None:
+    model = main.get_model()
+predictor = Predictor(model, "tree")
+predictor.predict_one([10.0, 1.0, 1.6])
+ready = time.perf_counter() - start
+print(json.dumps({{"ready_s": ready, "loaded": [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+
+def import_breakdown(fast : bool, top : int = 12) -> Dict[str, float]:
+    '''milliseconds spent importing each top level package on the way to ready'''
+
+    script = READY_SCRIPT.format(fast=fast, heavy=HEAVY)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                            capture_output=True, text=True, check=True)
+
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            _, cumulative, name = line.split("|")
+            cumulative_us = int(cumulative)
+        except ValueError:
+            continue # header line
+        if name.startswith("  "): # nested, already counted by its importer
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + cumulative_us
+
+    ordered = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {name: us / 1e3 for name, us in ordered}
+
+
+def time_to_ready(fast : bool, runs : int = 5) -> Dict[str, Any]:
+    '''median seconds from interpreter start of main to a first prediction'''
+
+    samples, loaded = [], []
+    for _ in range(runs):
+        script = READY_SCRIPT.format(fast=fast, heavy=HEAVY)
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+        samples.append(report["ready_s"])
+        loaded = report["loaded"]
+
+    return {"median_s": statistics.median(samples), "min_s": min(samples), "runs": runs, "heavy_imports": loaded}
+
+
+def run(runs : int = 5) -> Dict[str, Any]:
+
+    # the normal path also writes the compiled model the fast path needs
+    normal = time_to_ready(False, runs)
+    fast = time_to_ready(True, runs)
+    return {
+        "ready": {"normal": normal, "fast_start": fast},
+        "speedup": normal["median_s"] / fast["median_s"],
+        "imports_ms": {"normal": import_breakdown(False), "fast_start": import_breakdown(True)}
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Startup time of main.py, normal and --fast-start")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per mode")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = run(args.runs)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
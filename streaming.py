@@ -0,0 +1,176 @@
+# streaming.py
+# Author: Andrew Kelton
+
+'''
+Out-of-core training for answer archives larger than memory.
+  * iter_answer_chunks streams every answer file and session log record
+    as fixed size chunks of typed arrays (float64 X, int8 label codes).
+  * Models with partial_fit are updated chunk by chunk. Other models are
+    fit on a uniform or per label (stratified) reservoir sample.
+  * Peak memory is one chunk plus the reservoir, whatever the archive size.
+'''
+
+from typing import Callable, Iterator, Optional, Tuple
+import os
+
+import numpy as np
+
+from constants import COGNITIVE_ABILITIES_STRING
+from features import N_FEATURES, build_features, label_codes
+from session_log import SessionLog, DEFAULT_LOG_PATH
+
+DEFAULT_CHUNK_SIZE=65536
+N_LABELS=len(COGNITIVE_ABILITIES_STRING)
+
+
+def iter_answer_chunks(parse_file : Callable[[str], Tuple[np.ndarray, np.ndarray]],
+                       folder_path : str = "data",
+                       chunk_size : int = DEFAULT_CHUNK_SIZE
+                      ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    '''
+        Yields (X, y codes) chunks of at most chunk_size rows from every
+        answer file in folder_path, then from its session log.
+    '''
+
+    pending_X, pending_y, pending = [], [], 0
+
+    def sources() -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        for filename in sorted(os.listdir(folder_path)):
+            if filename.endswith(".json"):
+                yield parse_file(os.path.join(folder_path, filename))
+
+        # log records are featurized in batches of about chunk_size answers
+        batch, rows = [], 0
+        for record in SessionLog(os.path.join(folder_path, os.path.basename(DEFAULT_LOG_PATH))).scan():
+            batch.append(record.answers)
+            rows += len(record.answers)
+            if rows >= chunk_size:
+                yield _featurize(np.concatenate(batch))
+                batch, rows = [], 0
+        if batch:
+            yield _featurize(np.concatenate(batch))
+
+    for X, y in sources():
+        X = np.asarray(X, dtype=np.float64).reshape(-1, N_FEATURES)
+        y = np.asarray(y, dtype=np.int8)
+        while len(y):
+            take = chunk_size - pending
+            pending_X.append(X[:take])
+            pending_y.append(y[:take])
+            pending += len(y[:take])
+            X, y = X[take:], y[take:]
+
+            if pending == chunk_size:
+                yield np.concatenate(pending_X), np.concatenate(pending_y)
+                pending_X, pending_y, pending = [], [], 0
+
+    if pending:
+        yield np.concatenate(pending_X), np.concatenate(pending_y)
+
+def _featurize(answers : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''features and label codes for session log answer records'''
+    X = build_features(answers["result"], answers["difficulty"], answers["time_taken"])
+    return X, label_codes(X)
+
+
+class ReservoirSample:
+    '''
+        Uniform sample of at most capacity rows from a stream (algorithm R,
+        vectorized per chunk). With stratified, every label keeps its own
+        reservoir of capacity // N_LABELS rows so rare labels survive.
+    '''
+
+    def __init__(self, capacity : int, stratified : bool = False, seed : int = 0):
+
+        self.stratified = stratified
+        self.rng = np.random.default_rng(seed)
+        per_label = capacity // N_LABELS if stratified else capacity
+        n_reservoirs = N_LABELS if stratified else 1
+
+        self.capacity = per_label
+        self.X = [np.empty((per_label, N_FEATURES), dtype=np.float64) for _ in range(n_reservoirs)]
+        self.y = [np.empty(per_label, dtype=np.int8) for _ in range(n_reservoirs)]
+        self.filled = [0] * n_reservoirs
+        self.seen = [0] * n_reservoirs
+
+    def add(self, X : np.ndarray, y : np.ndarray) -> None:
+        '''offers a chunk to the sample'''
+
+        if self.stratified:
+            for label in range(N_LABELS):
+                mask = y == label
+                if mask.any():
+                    self.__add(label, X[mask], y[mask])
+        else:
+            self.__add(0, X, y)
+
+    def __add(self, r : int, X : np.ndarray, y : np.ndarray) -> None:
+
+        # fill the reservoir first
+        free = self.capacity - self.filled[r]
+        if free > 0:
+            n = min(free, len(y))
+            self.X[r][self.filled[r]:self.filled[r] + n] = X[:n]
+            self.y[r][self.filled[r]:self.filled[r] + n] = y[:n]
+            self.filled[r] += n
+            self.seen[r] += n
+            X, y = X[n:], y[n:]
+        if not len(y):
+            return
+
+        # row with stream index i replaces slot j ~ U[0, i] when j < capacity
+        index = self.seen[r] + np.arange(len(y))
+        slots = self.rng.integers(0, index + 1)
+        keep = slots < self.capacity
+        self.seen[r] += len(y)
+
+        # a later row wins when two rows hit the same slot
+        slots, rows = slots[keep][::-1], np.flatnonzero(keep)[::-1]
+        slots, first = np.unique(slots, return_index=True)
+        self.X[r][slots] = X[rows[first]]
+        self.y[r][slots] = y[rows[first]]
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''the sampled (X, y codes)'''
+        X = np.concatenate([X[:n] for X, n in zip(self.X, self.filled)])
+        y = np.concatenate([y[:n] for y, n in zip(self.y, self.filled)])
+        return X, y
+
+
+def train_streaming(model, parse_file : Callable[[str], Tuple[np.ndarray, np.ndarray]],
+                    folder_path : str = "data",
+                    chunk_size : int = DEFAULT_CHUNK_SIZE,
+                    sample_size : Optional[int] = None,
+                    stratified : bool = False,
+                    extra : Optional[Tuple[np.ndarray, np.ndarray]] = None):
+    '''
+        Trains model on the whole archive without loading it at once.
+        Models with partial_fit see every chunk. Others are fit on a
+        reservoir sample of sample_size rows (default 4 chunks). extra
+        (X, y labels), such as control data, is always included.
+    '''
+
+    classes = np.asarray(COGNITIVE_ABILITIES_STRING)
+    chunks = iter_answer_chunks(parse_file, folder_path, chunk_size)
+
+    if hasattr(model, "partial_fit"):
+        fitted = False
+        for X, y in chunks:
+            model.partial_fit(X, classes[y], classes=classes)
+            fitted = True
+        if extra is not None:
+            model.partial_fit(extra[0], extra[1], classes=classes)
+        elif not fitted:
+            raise ValueError(f"No training data in {folder_path}")
+        return model
+
+    sample = ReservoirSample(sample_size or 4 * chunk_size, stratified)
+    for X, y in chunks:
+        sample.add(X, y)
+
+    X, y = sample.arrays()
+    y = classes[y]
+    if extra is not None:
+        X = np.vstack([X, extra[0]])
+        y = np.concatenate([y, extra[1]])
+    return model.fit(X, y)